@@ -19,9 +19,19 @@ wiki_pwd = CryptContext(
     )
 
 from . import models
-from .wiki_util import wiki_markdown, logger
+from .wiki_util import wiki_markdown, render_cache, fragment_cache, login_record, search, title_index, \
+    jobs, compression, logger
 
-wiki_md = wiki_markdown.WikiMarkdown()
+compression.check_config(config)
+
+wiki_titles = title_index.TitleIndex(config.TITLE_INDEX_TTL)
+wiki_md = wiki_markdown.WikiMarkdown(render_cache=render_cache.from_config(config),
+                                     title_index=wiki_titles)
+login_records = login_record.LoginRecordBuffer(config.LOGIN_RECORD_BATCH_SIZE,
+                                               config.LOGIN_RECORD_FLUSH_INTERVAL)
+wiki_search = search.from_config(config)
+wiki_jobs = jobs.JobQueue(config.JOB_WORKERS, config.JOB_LEASE, config.JOB_MAX_ATTEMPTS)
+wiki_fragments = fragment_cache.from_config(config)
 
 
 def create_app():
@@ -43,6 +53,11 @@ def create_app():
     login_manager.anonymous_user = models.AnonymousUser
     mail.init_app(app)
 
+    # Register the handlers of background jobs, and run the jobs left 
+    # queued or unfinished by processes before this one.
+    from . import job_handlers
+    app.before_first_request(wiki_jobs.start)
+
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
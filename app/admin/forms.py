@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, \
-    SubmitField, IntegerField, SelectField
+    SubmitField, IntegerField, SelectField, BooleanField
 from wtforms.validators import DataRequired, Regexp, Email
 
 
@@ -87,6 +87,11 @@ class PageDeletionForm(FlaskForm):
     submit = SubmitField('Delete')
 
 
+class StubDeletionForm(FlaskForm):
+    linked = BooleanField('Also delete the stubs linked to, and remove the links to them')
+    submit = SubmitField('Delete empty stubs')
+
+
 class SearchForm(FlaskForm):
     search = StringField('Search')
     submit = SubmitField('Search')
@@ -2,19 +2,25 @@ import os
 import platform
 import subprocess
 import datetime
-from flask import request, redirect, url_for, flash, render_template
+from collections import Counter
+from bson import ObjectId
+from flask import request, redirect, url_for, flash, render_template, abort
 from flask_login import current_user
-from mongoengine.context_managers import switch_db
+from mongoengine.context_managers import switch_db, no_dereference
 from mongoengine.connection import _connection_settings as db_connection_settings
 from mongoengine.connection import disconnect
+from mongoengine.queryset.visitor import Q
 
 from . import admin
 from ..main.views import wiki_render_template
-from .. import config, basedir, db, wiki_pwd, wiki_md
-from ..models import WikiGroup, WikiPage, WikiPageVersion, WikiUser, WikiCache, WikiFile, WikiLoginRecord
+from .. import config, basedir, db, wiki_pwd, wiki_md, login_records, wiki_search, wiki_titles, \
+    wiki_jobs, wiki_fragments
+from ..models import WikiGroup, WikiPage, WikiPageVersion, WikiComment, WikiUser, WikiCache, WikiFile, \
+    WikiLoginRecord, WikiSearchLog, WikiJob
 from ..decorators import super_required, admin_required, user_required, guest_required
-from .forms import AddGroupForm, NewUserForm, ExistingUserForm, FileDeletionForm, PageDeletionForm, SearchForm
-from ..wiki_util.pagination import calc_page_num
+from .forms import AddGroupForm, NewUserForm, ExistingUserForm, FileDeletionForm, PageDeletionForm, SearchForm, \
+    StubDeletionForm
+from ..wiki_util.pagination import paginate_queryset, paginate_text_search, cached_count
 
 
 @admin.route('/super-admin', methods=['GET', 'POST'])
@@ -54,9 +60,12 @@ def wiki_super_admin():
                 else:
                     user.set_role(new_group.name_no_whitespace, 'Admin')
                     user.save()
+                    WikiUser.forget_cached()
                 WikiPage(title='Home', md='', html='', toc='').\
                     switch_db(new_group.name_no_whitespace).save()
-                WikiCache(keypages_id_title=[], changes_id_title=[]). \
+                # A new stamp, in case a deleted group of the same name is still cached.
+                WikiCache(keypages_id_title=[], changes_id_title=[],
+                          sidebar_stamp=ObjectId(), titles_stamp=ObjectId()). \
                     switch_db(new_group.name_no_whitespace).save()
                 flash('New group added')
                 return redirect(url_for('.wiki_super_admin'))
@@ -101,7 +110,6 @@ def wiki_activate_group(group):
 @admin.route('/delete-group/<group>')
 @super_required
 def wiki_delete_group(group):
-    # TODO: delete uploaded files
     wg = WikiGroup.objects(name_no_whitespace=group).first()
     if wg is not None:
         if wg.active:
@@ -109,38 +117,93 @@ def wiki_delete_group(group):
             disconnect(group)
         db.connection.drop_database(group)
         wg.delete()
-        users = WikiUser.objects.all()
-        for u in users:
-            if u.permissions:
-                u.save()
-            else:
-                u.delete()
+        wiki_search.forget(group)
+        wiki_titles.forget(group)
+        # Users and uploaded files are updated in the background.
+        wiki_jobs.enqueue('delete_group', group, current_user.name)
     return redirect(url_for('.wiki_super_admin'))
 
 
 @admin.route('/login-record')
 @super_required
 def wiki_show_login_record():
-    page_num = request.args.get('page', default=1, type=int)
-    records = WikiLoginRecord.objects.paginate(page=page_num, per_page=100)
-    start_page, end_page = calc_page_num(page_num, records.pages)
-    return render_template('admin/wiki_login_record.html',
-                           records=records,
-                           start_page=start_page,
-                           end_page=end_page,
-                           total_pages=records.pages)
+    login_records.flush()
+    try:
+        records = paginate_queryset(WikiLoginRecord.objects, [('timestamp', -1), ('id', -1)],
+                                    100, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    records.total = WikiLoginRecord.objects.count()
+    return render_template('admin/wiki_login_record.html', records=records)
+
+
+@admin.route('/jobs')
+@super_required
+def wiki_show_jobs():
+    """Background jobs of all the groups, latest first."""
+    try:
+        jobs = paginate_queryset(WikiJob.objects, [('created_on', -1), ('id', -1)],
+                                 100, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    return render_template('admin/wiki_jobs.html', jobs=jobs)
+
+
+@admin.route('/jobs/<job_id>/retry')
+@super_required
+def wiki_retry_job(job_id):
+    wiki_jobs.retry(job_id)
+    return redirect(request.referrer or url_for('.wiki_show_jobs'))
 
 
 @admin.route('/recent-user-activities')
 @super_required
 def wiki_recent_user_activities():
-    usernames = [u.name for u in WikiUser.objects.only('name').all()]
-    records = []
-    for username in usernames:
-        rec = WikiLoginRecord.objects(username=username).order_by('-timestamp').first()
-        records.append(rec)
-    records = list(filter(None.__ne__, records))
-    return render_template('admin/wiki_recent_user_activities.html', records=records)
+    """The latest login record of each user, latest first, 100 users per page.
+    Only the logins between `start` and `end` (YYYY-MM-DD, both included) 
+    are considered if given.
+    """
+    page_num = max(1, request.args.get('page', default=1, type=int))
+    start = request.args.get('start', default='')
+    end = request.args.get('end', default='')
+    per_page = 100
+
+    timestamp = {}
+    try:
+        if start:
+            timestamp['$gte'] = datetime.datetime.strptime(start, '%Y-%m-%d')
+        if end:
+            timestamp['$lt'] = datetime.datetime.strptime(end, '%Y-%m-%d') + datetime.timedelta(days=1)
+    except ValueError:
+        flash('Dates should be in the format YYYY-MM-DD.')
+        timestamp = {}
+    pipeline = [{'$match': {'timestamp': timestamp}}] if timestamp else []
+    # Sorting by the index on (username, -timestamp) puts 
+    # the latest record of each user first.
+    pipeline += [
+        {'$sort': {'username': 1, 'timestamp': -1}},
+        {'$group': dict({'_id': '$username'}, 
+                        **{f: {'$first': '$' + f} for f in 
+                           ['username', 'ip', 'browser', 'platform', 'timestamp', 'details']})},
+        # Leave out the users who have been deleted.
+        {'$lookup': {'from': WikiUser._get_collection_name(), 
+                     'localField': '_id', 
+                     'foreignField': 'name', 
+                     'as': 'user'}},
+        {'$match': {'user': {'$ne': []}}},
+        {'$project': {'user': 0}},
+        {'$sort': {'timestamp': -1}},
+        {'$skip': (page_num - 1) * per_page},
+        {'$limit': per_page + 1}
+    ]
+    login_records.flush()
+    records = list(WikiLoginRecord.objects.aggregate(*pipeline))
+    return render_template('admin/wiki_recent_user_activities.html', 
+                           records=records[:per_page],
+                           page_num=page_num,
+                           has_next=len(records) > per_page,
+                           start=start,
+                           end=end)
 
 
 @admin.route('/all-users')
@@ -188,6 +251,7 @@ def wiki_group_admin(group):
         elif not user.belong_to(group) and not user.is_super_admin():
             user.set_role(group, form.access.data)
             user.save()
+            WikiUser.forget_cached()
             flash('New user added')
             return redirect(url_for('.wiki_group_admin', group=group))
         else:
@@ -223,6 +287,7 @@ def wiki_group_manage_user(group, user_id):
             if user.get_role(group) != form.access.data:
                 user.set_role(group, form.access.data)
             user.save()
+        WikiUser.forget_cached()
         return redirect(url_for('.wiki_group_admin', group=group))
 
     form.email.data = user.email
@@ -235,23 +300,27 @@ def wiki_group_manage_user(group, user_id):
 @admin_required
 def wiki_show_all_wikipages(group):
     search_keyword = request.args.get('search')
-    page_num = request.args.get('page', default=1, type=int)
+    cursor = request.args.get('cursor')
     
     delete_form = PageDeletionForm()
     search_form = SearchForm(search=search_keyword)
-    if search_keyword and not search_keyword.isspace():
-        with switch_db(WikiPage, group) as _WikiPage:
-            results = _WikiPage.objects(title__ne='Home').\
-                search_text(search_keyword).order_by('id').\
-                only('title', 'modified_on', 'modified_by', 'current_version').\
-                order_by('$text_score').paginate(page=page_num, per_page=100)
-        start_page, end_page = calc_page_num(page_num, results.pages)
-    else:
-        with switch_db(WikiPage, group) as _WikiPage:
-            results = _WikiPage.objects(title__ne='Home').order_by('id').\
-                only('title', 'modified_on', 'modified_by', 'current_version').\
-                paginate(page=page_num, per_page=100)
-        start_page, end_page = calc_page_num(page_num, results.pages)
+    fields = ['title', 'modified_on', 'modified_by', 'current_version']
+    with switch_db(WikiPage, group) as _WikiPage:
+        try:
+            if search_keyword and not search_keyword.isspace():
+                results = paginate_text_search(_WikiPage.objects, search_keyword, fields, 
+                                               100, cursor, title={'$ne': 'Home'})
+                results.total = cached_count((group, 'all-wikipages', search_keyword),
+                                             _WikiPage.objects(title__ne='Home').\
+                                                 search_text(search_keyword),
+                                             config.COUNT_CACHE_TTL)
+            else:
+                results = paginate_queryset(_WikiPage.objects(title__ne='Home').only(*fields),
+                                            [('id', 1)], 100, cursor)
+                # Counting the whole collection only reads its metadata.
+                results.total = _WikiPage.objects.count() - 1
+        except ValueError:
+            abort(400)
     
     if search_form.validate_on_submit():
         return redirect(url_for('.wiki_show_all_wikipages', 
@@ -262,51 +331,152 @@ def wiki_show_all_wikipages(group):
                                 group=group,
                                 delete_form=delete_form,
                                 search_form=search_form,
-                                results=results,
-                                start_page=start_page,
-                                end_page=end_page,
-                                total_pages=results.pages)
+                                results=results)
+
+
+def delete_wikipages(group, pages, unlink=True, condition=None):
+    """Delete pages along with their history and comments, in a few batched operations.
+    
+    :param group: group name (no whitespace)
+    :param pages: the pages, with `title`, `former_titles`, `versions` and `refs` loaded, 
+        `versions` for the history saved before `WikiPageVersion.page_id` was added
+    :param unlink: whether the pages linking to them should be updated, 
+        which is done in the background
+    :param condition: a queryset of `WikiPage` in the group, e.g. `empty_stubs()`, 
+        which the pages must still match when deleted, since they may have 
+        been changed after being loaded; the pages which do not are kept
+    :return: the pages deleted
+    """
+    if not pages:
+        return []
+    page_ids = [p.id for p in pages]
+    with switch_db(WikiPage, group) as _WikiPage, \
+            switch_db(WikiPageVersion, group) as _WikiPageVersion, \
+            switch_db(WikiComment, group) as _WikiComment, \
+            switch_db(WikiCache, group) as _WikiCache:
+        if condition is None:
+            condition = _WikiPage.objects
+        condition.filter(id__in=page_ids).delete()
+        # Only clean up after the pages actually deleted.
+        kept = {p.id for p in _WikiPage.objects(id__in=page_ids).only('id')}
+        pages = [p for p in pages if p.id not in kept]
+        if not pages:
+            return []
+        page_ids = [p.id for p in pages]
+        id_titles = [[p.id, p.title] for p in pages]
+        with no_dereference(_WikiPage):
+            version_ids = [v.id for p in pages for v in p.versions]
+            # The pages they mention lose one backlink per page deleted, 
+            # even if mentioned more than once by pages saved before `update_refs` deduplicated them.
+            backlinks_lost = Counter(i for p in pages for i in {r.id for r in p.refs})
+        _WikiPageVersion.objects(Q(page_id__in=page_ids) | Q(id__in=version_ids)).delete()
+        _WikiComment.objects(page_id__in=page_ids).delete()
+        _WikiCache.objects.update_one(pull_all__changes_id_title=id_titles,
+                                      pull_all__keypages_id_title=id_titles,
+                                      set__sidebar_stamp=ObjectId())
+        _WikiCache.forget_sidebar(group)
+        wiki_md.invalidate(group, page_ids=page_ids)
+        for n in set(backlinks_lost.values()):
+            _WikiPage.objects(id__in=[i for i, c in backlinks_lost.items() if c == n]).\
+                update(dec__backlinks=n, set__fragment_stamp=ObjectId())
+    if wiki_fragments is not None:
+        wiki_fragments.invalidate(group, page_ids)
+    WikiSearchLog.add(group, *page_ids)
+    wiki_titles.update(group, removed=[(p.id, p.title) for p in pages])
+    if unlink:
+        wiki_jobs.enqueue('unlink_pages', group, current_user.name,
+                          page_ids=[str(i) for i in page_ids],
+                          titles=[t for p in pages for t in [p.title] + p.former_titles])
+    return pages
 
 
 @admin.route('/<group>/delete-wikipage', methods=['POST'])
 @admin_required
 def wiki_group_delete_wikipage(group):
     form = PageDeletionForm()
-    with switch_db(WikiFile, group) as _WikiFile, \
-            switch_db(WikiPage, group) as _WikiPage, \
-            switch_db(WikiPageVersion, group) as _WikiPageVersion, \
-            switch_db(WikiCache, group) as _WikiCache:
-        page_to_delete = _WikiPage.objects(id=form.page_id.data).first()
-        _WikiPageVersion.objects(id__in=[pv.id for pv in page_to_delete.versions]).delete()
-        _WikiCache.objects.update_one(pull__changes_id_title=(page_to_delete.id, page_to_delete.title),
-                                      pull__keypages_id_title=(page_to_delete.id, page_to_delete.title))
-        if page_to_delete.title != 'Home':
-            for wp in _WikiPage.objects(refs__contains=page_to_delete.id):
-                wp_md = wp.md.replace('[[{}]]'.format(page_to_delete.title), '')
-                wp_toc, wp_html = wiki_md(group, wp_md)
-                _WikiPage.objects(id=wp.id).update_one(set__md=wp_md,
-                                                       set__html=wp_html,
-                                                       set__toc=wp_toc)
-            page_to_delete.delete()
+    with switch_db(WikiPage, group) as _WikiPage:
+        page_to_delete = _WikiPage.objects(id=form.page_id.data).\
+            only('id', 'title', 'former_titles', 'versions', 'refs').first()
+    if page_to_delete is not None and page_to_delete.title != 'Home':
+        delete_wikipages(group, [page_to_delete])
     return ''
 
 
+@admin.route('/<group>/link-report')
+@admin_required
+def wiki_link_report(group):
+    """Pages no page links to, empty stubs, or the pages linked to the most, 
+    based on the backlinks kept by `WikiPage.update_refs`.
+    """
+    report = request.args.get('report', 'orphans')
+    fields = ['title', 'modified_on', 'modified_by', 'current_version', 'backlinks']
+    with switch_db(WikiPage, group) as _WikiPage:
+        if report == 'orphans':
+            pages, sort_keys = _WikiPage.objects(backlinks=0, title__ne='Home'), [('id', 1)]
+        elif report == 'stubs':
+            pages, sort_keys = _WikiPage.empty_stubs(), [('id', 1)]
+        elif report == 'hubs':
+            pages, sort_keys = _WikiPage.objects(backlinks__gt=0), [('backlinks', -1), ('id', -1)]
+        else:
+            abort(404)
+        try:
+            results = paginate_queryset(pages.only(*fields), sort_keys, 100, 
+                                        request.args.get('cursor'))
+        except ValueError:
+            abort(400)
+        if report != 'hubs':
+            results.total = cached_count((group, 'link-report', report), pages, 
+                                         config.COUNT_CACHE_TTL)
+    return wiki_render_template('admin/wiki_link_report.html',
+                                group=group,
+                                report=report,
+                                results=results,
+                                delete_form=StubDeletionForm())
+
+
+@admin.route('/<group>/delete-stubs', methods=['POST'])
+@admin_required
+def wiki_group_delete_stubs(group):
+    form = StubDeletionForm()
+    if form.validate_on_submit():
+        with switch_db(WikiPage, group) as _WikiPage:
+            stubs = _WikiPage.empty_stubs()
+            if not form.linked.data:
+                stubs = stubs.filter(backlinks=0)
+            pages = list(stubs.only('id', 'title', 'former_titles', 'versions', 'refs'))
+        # Pages edited, commented on or linked to in the meantime are kept.
+        deleted = delete_wikipages(group, pages, unlink=form.linked.data, condition=stubs)
+        flash('{} empty stubs deleted.'.format(len(deleted)))
+    return redirect(url_for('.wiki_link_report', group=group, report='stubs'))
+
+
+@admin.route('/<group>/jobs')
+@admin_required
+def wiki_show_group_jobs(group):
+    """Background jobs of a group, latest first."""
+    try:
+        jobs = paginate_queryset(WikiJob.objects(group=group), [('created_on', -1), ('id', -1)],
+                                 100, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    return wiki_render_template('admin/wiki_jobs.html', group=group, jobs=jobs)
+
+
 @admin.route('/<group>/all-files')
 @admin_required
 def wiki_show_all_files(group):
-    # TODO: server error when there is no uploaded files
-    page_num = request.args.get('page', default=1, type=int)
     with switch_db(WikiFile, group) as _WikiFile:
-        files = _WikiFile.objects.paginate(page=page_num, per_page=100)
-    start_page, end_page = calc_page_num(page_num, files.pages)
+        try:
+            files = paginate_queryset(_WikiFile.objects, [('id', 1)], 100, 
+                                      request.args.get('cursor'))
+        except ValueError:
+            abort(400)
+        files.total = _WikiFile.objects.count()
     form = FileDeletionForm()
     return wiki_render_template('admin/wiki_show_all_files.html',
                                 group=group,
                                 form=form,
-                                files=files,
-                                start_page=start_page,
-                                end_page=end_page,
-                                total_pages=files.pages)
+                                files=files)
 
 
 @admin.route('/<group>/delete-file', methods=['POST'])
@@ -319,6 +489,7 @@ def wiki_group_delete_file(group):
         _WikiPage.objects(files__contains=file_to_delete.id).\
             update(pull__files=file_to_delete)
         file_to_delete.delete()
+    wiki_md.invalidate(group, file_id=file_to_delete.id)
     os.remove(os.path.join(config.UPLOAD_FOLDER, group, str(form.file_id.data)))
     return ''
 
@@ -326,14 +497,29 @@ def wiki_group_delete_file(group):
 @admin.route('/<group>/delete-comment/<page_id>/<comment_id>')
 @user_required
 def wiki_group_delete_comment(group, page_id, comment_id):
-    with switch_db(WikiPage, group) as _WikiPage:
-        page = _WikiPage.objects(id=page_id).only('comments').first()
-        for c in page.comments:
-            if c.id == comment_id:
-                comment_to_del = c
+    if not ObjectId.is_valid(page_id):
+        abort(404)
+    with switch_db(WikiPage, group) as _WikiPage, \
+            switch_db(WikiComment, group) as _WikiComment:
+        comment_to_del = None
+        if ObjectId.is_valid(comment_id):
+            comment_to_del = _WikiComment.objects(id=comment_id, page_id=page_id).\
+                only('id', 'page_id', 'author').first()
+        if comment_to_del is None:
+            # A comment still saved in its page, see `manage.py migrate_comments`
+            page = _WikiPage.objects(id=page_id, comments__id=comment_id).only('id', 'comments').first_or_404()
+            author = next(c.get('author') for c in page.comments if c.get('id') == comment_id)
+            if current_user.is_admin(group) or author == current_user.name:
+                _WikiPage.objects(id=page.id).update_one(pull__comments={'id': comment_id},
+                                                         set__fragment_stamp=ObjectId())
+                WikiSearchLog.add(group, page.id)
+            return redirect(request.referrer)
         
         if current_user.is_admin(group) or \
                 comment_to_del.author == current_user.name:
-            _WikiPage.objects(id=page.id).update_one(pull__comments=comment_to_del)
+            if _WikiComment.objects(id=comment_to_del.id).delete():
+                _WikiPage.objects(id=comment_to_del.page_id).update_one(dec__comment_count=1,
+                                                                      set__fragment_stamp=ObjectId())
+            WikiSearchLog.add(group, comment_to_del.page_id)
             
         return redirect(request.referrer)
@@ -3,7 +3,7 @@ from flask import request, redirect, url_for, flash, render_template, session
 
 from . import auth
 from ..main.views import wiki_render_template
-from .. import wiki_pwd
+from .. import wiki_pwd, login_records
 from ..decorators import super_required, guest_required
 from ..models import WikiUser, WikiGroup, WikiLoginRecord
 from .forms import LoginForm, ChangePwdForm
@@ -20,13 +20,13 @@ def wiki_super_login():
         if user is not None and user.verify_password(form.password.data) \
                 and user.is_super_admin():
             login_user(user, form.remember_me.data)
-            WikiLoginRecord(
+            login_records.add(WikiLoginRecord(
                 username=form.username.data,
                 browser=request.user_agent.browser, 
                 platform=request.user_agent.platform, 
                 details=request.user_agent.string, 
                 ip=request.remote_addr, 
-            ).save()
+            ))
             return redirect(url_for('admin.wiki_super_admin'))
         flash('Invalid username or password.')
     return render_template('auth/wiki_login.html', form=form)
@@ -57,13 +57,13 @@ def wiki_group_login(group):
                 and user.verify_password(form.password.data):
             login_user(user, form.remember_me.data)
             session.permanent = True
-            WikiLoginRecord(
+            login_records.add(WikiLoginRecord(
                 username=form.username.data,
                 browser=request.user_agent.browser, 
                 platform=request.user_agent.platform, 
                 details=request.user_agent.string, 
                 ip=request.remote_addr, 
-            ).save()
+            ))
             return redirect(
                 request.args.get('next')
                 or url_for('main.wiki_group_home', group=group)
@@ -95,6 +95,7 @@ def wiki_change_password(group, username):
         else:
             WikiUser.objects(name=current_user.name).\
                 update_one(set__password_hash=wiki_pwd.hash(form.new_password.data))
+            WikiUser.forget_cached()
             flash('Password changed.')
     
     all_users = [u for u in WikiUser.objects.order_by('username') if u.belong_to(group)]
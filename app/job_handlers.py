@@ -0,0 +1,76 @@
+import os
+import re
+import shutil
+from bson import ObjectId
+from mongoengine.context_managers import switch_db
+from . import config, wiki_jobs
+from .models import WikiGroup, WikiPage, WikiUser, WikiSearchLog
+from .wiki_util.title_index import link_regex
+from .wiki_util.wiki_markdown import page_regex
+
+
+@wiki_jobs.handler('unlink_pages')
+def unlink_pages(job):
+    """Remove the links to deleted pages from the pages linking to them.
+    The links are cut out of their html as well, instead of rendering
+    their markdown again.
+
+    :param page_ids: ids of the pages deleted
+    :param titles: their titles and former titles
+    """
+    group = job.group
+    page_ids = [ObjectId(i) for i in job.params['page_ids']]
+    deleted = set(job.params['page_ids'])
+    titles = set(job.params['titles'])
+    with switch_db(WikiPage, group) as _WikiPage:
+        # Pages done no longer link to the pages, and are skipped if run again.
+        pages = _WikiPage.objects(refs__in=page_ids).only('id', 'md', 'html')
+        total = pages.count()
+        for done, p in enumerate(pages, 1):
+            md = re.sub(page_regex, lambda m: '' if m.group(1) in titles else m.group(0),
+                        p.md or '', flags=re.DOTALL)
+            html = link_regex.sub(lambda m: '' if m.group(2) in deleted else m.group(0),
+                                  p.html or '')
+            _WikiPage.objects(id=p.id).update_one(set__md=md, set__html=html,
+                                                  pull_all__refs=page_ids,
+                                                  set__fragment_stamp=ObjectId())
+            WikiSearchLog.add(group, p.id)
+            if done % 100 == 0:
+                wiki_jobs.progress(job, done, total)
+    wiki_jobs.progress(job, total, total)
+
+
+@wiki_jobs.handler('replace_links')
+def replace_links(job):
+    """Change [[links]] using a former title of a page to its current title,
+    once another page has taken the former title, see `WikiPage.rename`.
+
+    :param page_id: id of the page
+    :param old_title: the former title taken
+    """
+    group = job.group
+    with switch_db(WikiPage, group) as _WikiPage:
+        page = _WikiPage.objects(id=job.params['page_id']).only('id', 'title').first()
+        if page is None:
+            return
+        # Pages done no longer contain the former title, and are skipped if run again.
+        changed_ids = page.replace_links(group, job.params['old_title'], page.title)
+    WikiSearchLog.add(group, *changed_ids)
+    wiki_jobs.progress(job, len(changed_ids), len(changed_ids))
+
+
+@wiki_jobs.handler('delete_group')
+def delete_group(job):
+    """Remove a deleted group from the permissions of the users,
+    delete the users left without any group, and the files uploaded.
+    """
+    group = job.group
+    if WikiGroup.objects(name_no_whitespace=group).first() is not None:
+        # Created again since
+        return
+    WikiUser.objects(**{'permissions__{}__exists'.format(group): True}).\
+        update(**{'unset__permissions__{}'.format(group): True})
+    WikiUser.objects(permissions={}).delete()
+    WikiUser.forget_cached()
+    shutil.rmtree(os.path.join(config.UPLOAD_FOLDER, group), ignore_errors=True)
+    wiki_jobs.progress(job, 1, 1)
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, \
-    IntegerField, TextAreaField, FileField
+    IntegerField, TextAreaField, FileField, BooleanField
 from wtforms.validators import DataRequired, Length
 
 
@@ -15,6 +15,7 @@ class WikiEditForm(BasicEditForm):
 
 class SearchForm(FlaskForm):
     search = StringField('Search')
+    history = BooleanField('Search page history')
     submit = SubmitField('Search')
 
 
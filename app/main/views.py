@@ -1,40 +1,48 @@
 import os
 import re
+import time
+import hashlib
 from datetime import datetime, date
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from bson import ObjectId
 from flask import request, redirect, render_template, \
-    url_for, flash, send_from_directory
+    url_for, flash, send_from_directory, abort, jsonify, make_response, current_app
 from flask_login import current_user
-from mongoengine import DoesNotExist
 from mongoengine.context_managers import switch_db
+from mongoengine.errors import SaveConditionError
 from bs4 import BeautifulSoup
 
 from . import main
-from .. import config, basedir, wiki_md
+from .. import config, basedir, wiki_md, wiki_search, wiki_titles, wiki_jobs, wiki_fragments
 from .forms import BasicEditForm, WikiEditForm, SearchForm, CommentForm,\
     RenameForm, UploadForm, VersionRecoverForm
-from ..models import Permission, WikiGroup, WikiComment, WikiPage, WikiFile, WikiCache,\
+from ..models import Permission, WikiGroup, WikiComment, WikiPage, WikiFile, WikiCache, WikiSearchLog,\
     render_wiki_file, render_wiki_image
 from ..email import send_email
-from ..wiki_util.pagination import calc_page_num
+from ..wiki_util.pagination import calc_page_num, encode_cursor, paginate_queryset
+from ..wiki_util.fragment_cache import fragment_key
+from ..wiki_util.search import search_history
+from ..wiki_util.wiki_markdown import normalize_wiki_links
 
 from ..decorators import admin_required, user_required, guest_required
 
 
 def wiki_render_template(template, group, *args, **kwargs):
     with switch_db(WikiCache, group) as _WikiCache:
-        _cache = _WikiCache.objects.first()
-        
-        if _cache.latest_change_time.date() == date.today():
-            latest_change_time = _cache.latest_change_time.strftime('[%H:%M]')
-        else:
-            latest_change_time = _cache.latest_change_time.strftime('[%b %d]')
+        keypages_id_title, changes_id_title, latest_change_time = \
+            _WikiCache.load_sidebar(group)
         
-        return render_template(template, group=group,
-                               keypages_id_title=_cache.keypages_id_title,
-                               changes_id_title=_cache.changes_id_title[:-6:-1],
-                               latest_change_time = latest_change_time,
-                               *args, **kwargs)
+    if latest_change_time.date() == date.today():
+        latest_change_time = latest_change_time.strftime('[%H:%M]')
+    else:
+        latest_change_time = latest_change_time.strftime('[%b %d]')
+    
+    return render_template(template, group=group,
+                           keypages_id_title=keypages_id_title,
+                           changes_id_title=changes_id_title,
+                           latest_change_time = latest_change_time,
+                           *args, **kwargs)
 
 
 @main.route('/')
@@ -46,33 +54,43 @@ def index():
 @main.route('/<group>/search', methods=['GET', 'POST'])
 @guest_required
 def search(group):
-    """Search text on wiki page, `weights{ title:10, content:2, comment:1 }`
+    """Search text on wiki page, `weights{ title:10, content:2, comment:1 }`, 
+    or on the diffs of previous versions with `history=1`.
     """
     search_keyword = request.args.get('search')
-    result_page = request.args.get('page', default=1, type=int)
-    form = SearchForm(search=search_keyword)
-    results, start_page, end_page = None, None, None
+    history = request.args.get('history', default=0, type=int) == 1
+    cursor = request.args.get('cursor')
+    form = SearchForm(search=search_keyword, history=history)
+    results = None
     if search_keyword and not search_keyword.isspace():
-        with switch_db(WikiPage, group) as _WikiPage:
-            results = _WikiPage.objects.search_text(search_keyword). \
-                only('id', 'title', 'modified_on', 'modified_by'). \
-                order_by('$text_score').paginate(page=result_page, per_page=100)
-        start_page, end_page = calc_page_num(result_page, results.pages)
+        try:
+            if history:
+                results = search_history(group, search_keyword, 100, cursor)
+            else:
+                results = wiki_search.search(group, search_keyword, 100, cursor)
+        except ValueError:
+            abort(400)
 
     if form.validate_on_submit():
-        return redirect(url_for('.search', group=group, search=form.search.data))
+        return redirect(url_for('.search', group=group, search=form.search.data,
+                                history=1 if form.history.data else None))
         
-    try:
-        total_pages = results.pages
-    except AttributeError:
-        total_pages = 0
     return wiki_render_template('search.html', 
                                 group=group, 
                                 form=form, 
-                                results=results,
-                                start_page=start_page, 
-                                end_page=end_page,
-                                total_pages=total_pages)
+                                history=history,
+                                results=results)
+
+
+@main.route('/<group>/titles')
+@guest_required
+def wiki_page_titles(group):
+    """Titles of the pages starting with `prefix`, ignoring case, 
+    to complete [[links]] in the editor.
+    """
+    prefix = request.args.get('prefix', default='')
+    limit = min(request.args.get('limit', default=10, type=int), 50)
+    return jsonify(titles=wiki_titles.complete(group, prefix, limit))
 
 
 @main.route('/<group>/keypage-edit', methods=['GET', 'POST'])
@@ -92,20 +110,45 @@ def wiki_keypage_edit(group):
 @main.route('/<group>/changes')
 @guest_required
 def wiki_show_changes(group):
+    """The changes kept in `WikiCache`, latest first. Older changes are then 
+    listed by `modified_on`, 50 pages at a time, leaving out the pages 
+    kept in `WikiCache`.
+    """
+    cursor = request.args.get('cursor')
     with switch_db(WikiPage, group) as _WikiPage, \
             switch_db(WikiCache, group) as _WikiCache:
         _cache = _WikiCache.objects.only('changes_id_title').first()
-        changed_pages = []
-        for _id, pageTitle in _cache.changes_id_title[::-1]:
+        if cursor is None:
+            changes = _cache.changes_id_title[::-1]
+            pages = _WikiPage.objects(id__in=[_id for _id, _ in changes]).\
+                only('id', 'title', 'modified_by', 'modified_on')
+            pages_by_id = {p.id: p for p in pages}
+            changed_pages = [pages_by_id[_id] for _id, _ in changes if _id in pages_by_id]
+            
+            # Forget the pages which no longer exist.
+            missing = [c for c in changes if c[0] not in pages_by_id]
+            if missing:
+                _WikiCache.objects.update_one(pull_all__changes_id_title=missing,
+                                              set__sidebar_stamp=ObjectId())
+                _WikiCache.forget_sidebar(group)
+            
+            # Listed from the latest `modified_on` again: comments put pages 
+            # edited long ago among the changes, without modifying them.
+            older = encode_cursor(None, 2) if changed_pages else None
+        else:
+            shown = [_id for _id, _ in _cache.changes_id_title]
             try:
-                changed_pages.append(_WikiPage.objects.\
-                    only('id', 'title', 'modified_by', 'modified_on').get(id=_id))
-            except DoesNotExist:
-                # TODO: handle it rather than ignore it
-                pass
+                results = paginate_queryset(_WikiPage.objects(id__nin=shown).\
+                                                only('id', 'title', 'modified_by', 'modified_on'),
+                                            [('modified_on', -1), ('id', -1)], 50, cursor)
+            except ValueError:
+                abort(400)
+            changed_pages, older = results.items, results.next_cursor
+    
     return wiki_render_template('wiki_changes.html',
                                 group=group,
-                                changed_pages=changed_pages)
+                                changed_pages=changed_pages,
+                                older=older)
 
 
 @main.route('/<group>/<page_id>/page', methods=['GET', 'POST'])
@@ -115,18 +158,20 @@ def wiki_page(group, page_id):
 
     if form.validate_on_submit() and current_user.can(group, Permission.WRITE):
         _, comment_html = wiki_md(group, form.textArea.data, is_comment=True)
-        new_comment = WikiComment(
-            id='{}-{}'.format(datetime.utcnow().strftime('%s'), current_user.id),
-            author=current_user.name,
-            html=comment_html,
-            md=form.textArea.data
-        )
         with switch_db(WikiPage, group) as _WikiPage, \
+                switch_db(WikiComment, group) as _WikiComment, \
                 switch_db(WikiCache, group) as _WikiCache:
-            _WikiPage.objects(id=page_id).update_one(push__comments=new_comment)
             page = _WikiPage.objects.only('id', 'title').get_or_404(id=page_id)
+            _WikiComment(page_id=page.id,
+                         author=current_user.name,
+                         html=comment_html,
+                         md=form.textArea.data).save()
+            _WikiPage.objects(id=page.id).update_one(inc__comment_count=1,
+                                                     set__fragment_stamp=ObjectId())
             _cache = _WikiCache.objects.only('changes_id_title').first()
             _cache.add_changed_page(page.id, page.title, datetime.now())
+            _WikiCache.forget_sidebar(group)
+            WikiSearchLog.add(group, page.id)
 
             user_emails = [u.email for u in wiki_md.users_to_notify]
             send_email(user_emails, 'You are mentioned', 
@@ -140,9 +185,151 @@ def wiki_page(group, page_id):
                                     page_id=page_id, 
                                     _anchor='wiki-comment-box'))
 
+    state = page_state(group, page_id)
+    conditional = request.method == 'GET'
+    if conditional:
+        etag, last_modified = page_validators(group, state)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response('', 304)
+            set_page_validators(response, etag, last_modified)
+            return response
+
+    fragments = wiki_page_fragments(group, state)
+    page = WikiPage(id=state['_id'], title=state['title'])
+    response = make_response(wiki_render_template('wiki_page.html', 
+                                                  group=group, 
+                                                  page=page, 
+                                                  fragments=fragments, 
+                                                  form=form))
+    if conditional:
+        set_page_validators(response, etag, last_modified)
+    return response
+
+
+def page_state(group, page_id):
+    """What `wiki_page` shows of a page depends on, looked up without 
+    loading the page: its title, `fragment_stamp`, version, modification 
+    time, number of comments, the authors of the comments still saved 
+    in the page, and the stamp of the titles of the pages it links to.
+    
+    :param group: group name (no whitespace)
+    :return: a dict of the fields of the page, and `titles_stamp`
+    """
+    if not ObjectId.is_valid(page_id):
+        abort(404)
     with switch_db(WikiPage, group) as _WikiPage:
-        page = _WikiPage.objects.exclude('md', 'refs', 'files').get_or_404(id=page_id)
-    return wiki_render_template('wiki_page.html', group=group, page=page, form=form)
+        state = _WikiPage.objects(id=page_id).\
+            only('id', 'title', 'fragment_stamp', 'current_version', 'modified_on', 'comment_count', 
+                 'comments.author').\
+            as_pymongo().first()
+    if state is None:
+        abort(404)
+    # The titles as they are shown, possibly cached by this process
+    state['titles_stamp'] = wiki_titles.stamp(group)
+    return state
+
+
+def page_validators(group, state):
+    """The ETag and the last modification time of a page as `wiki_page` 
+    shows it to the current user.
+    
+    The ETag changes with the page, its comments, the sidebar, the titles 
+    of the pages it may link to, and what the user is allowed to do. 
+    The last modification time also accounts for the latest comment, 
+    since commenting is a change of the group.
+    
+    :param group: group name (no whitespace)
+    :param state: see `page_state`
+    :return: the ETag, and the last modification time in UTC
+    """
+    # The sidebar as it is shown, possibly cached by this process
+    with switch_db(WikiCache, group) as _WikiCache:
+        _, _, latest_change_time = _WikiCache.load_sidebar(group)
+        sidebar_stamp = _WikiCache.loaded_sidebar_stamp(group)
+    can_write = current_user.can(group, Permission.WRITE)
+    # The token of the comment form expires, see `WTF_CSRF_TIME_LIMIT`.
+    csrf_time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 0
+    csrf_period = int(time.time() // (csrf_time_limit / 2)) if can_write and csrf_time_limit else 0
+    key = (group, state['_id'], state.get('fragment_stamp'), state['current_version'], 
+           state.get('comment_count', 0), sidebar_stamp, state['titles_stamp'], date.today(), 
+           current_user.id, can_write, current_user.is_admin(group), csrf_period)
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+    
+    last_modified = max(state['modified_on'], latest_change_time or state['modified_on'])
+    # Dates are saved in local time, HTTP dates are in UTC.
+    return etag, datetime.utcfromtimestamp(last_modified.timestamp())
+
+
+def set_page_validators(response, etag, last_modified):
+    # Weak, since the token of the comment form differs each time.
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # Browsers may keep the page, but must check with `If-None-Match` before showing it.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+
+def wiki_page_fragments(group, state):
+    """The table of contents, the content and a page of the comments 
+    of a page, rendered once for all the users who see them the same way, 
+    see `FRAGMENT_CACHE_BACKEND`.
+    
+    :param group: group name (no whitespace)
+    :param state: see `page_state`
+    :return: html of each part, by name
+    """
+    cursor = request.args.get('cursor')
+    # Comments not moved yet by `manage.py migrate_comments`
+    legacy_authors = {c.get('author') for c in state.get('comments') or []}
+    with switch_db(WikiComment, group) as _WikiComment:
+        # Only admins and the authors of comments see links to delete them.
+        if current_user.is_admin(group):
+            viewer = 'admin'
+        elif current_user.is_authenticated and (current_user.name in legacy_authors or 
+                _WikiComment.objects(page_id=state['_id'], author=current_user.name).only('id').first()):
+            viewer = current_user.name
+        else:
+            viewer = ''
+        key = fragment_key(state['_id'], 'page', state.get('fragment_stamp'), state['current_version'], 
+                           state.get('comment_count', 0), state['titles_stamp'], cursor, viewer)
+        fragments = wiki_fragments.get(group, key) if wiki_fragments is not None else None
+        if fragments is not None:
+            return fragments
+
+        # Latest first, so that a new comment shows right below the comment box
+        try:
+            comments = paginate_queryset(_WikiComment.objects(page_id=state['_id']),
+                                         [('timestamp', -1), ('id', -1)], 50, cursor)
+        except ValueError:
+            abort(400)
+        comments.total = state.get('comment_count', 0)
+    with switch_db(WikiPage, group) as _WikiPage:
+        page = _WikiPage.objects.exclude('md', 'versions', 'refs', 'files', 
+                                         *([] if legacy_authors else ['comments'])).\
+            get_or_404(id=state['_id'])
+    if legacy_authors:
+        # Older than the comments moved, so shown after them
+        comments.total += len(page.comments)
+        if comments.next_cursor is None:
+            comments.items += [WikiComment(page_id=page.id, id=c.get('id'), timestamp=c.get('timestamp'),
+                                           author=c.get('author'), html=c.get('html'), md=c.get('md'))
+                               for c in reversed(page.comments)]
+    # Show the current titles of the pages linked to, which may have been renamed.
+    htmls = wiki_titles.resolve_links(group, page.html, *[c.html for c in comments.items])
+    page.html = htmls[0]
+    for comment, html in zip(comments.items, htmls[1:]):
+        comment.html = html
+    fragments = {
+        'toc': page.toc or '',
+        'content': render_template('_wiki_page_content.html', group=group, page=page),
+        'comments': render_template('_wiki_page_comments.html', 
+                                    group=group, 
+                                    page=page, 
+                                    comments=comments)
+    }
+    if wiki_fragments is not None:
+        wiki_fragments.set(group, key, page.id, fragments)
+    return fragments
 
 
 href_prog = re.compile(r'\/(.+?)\/([0-9a-f]{24})\/page(#.*)?')
@@ -152,35 +339,40 @@ href_prog = re.compile(r'\/(.+?)\/([0-9a-f]{24})\/page(#.*)?')
 @user_required
 def wiki_page_edit(group, page_id):
     with switch_db(WikiPage, group) as _WikiPage:
-        page = _WikiPage.objects.exclude('html', 'comments').get_or_404(id=page_id)
+        page = _WikiPage.objects.exclude('html', 'comments', 'versions').get_or_404(id=page_id)
         form = WikiEditForm(current_version=page.current_version)
         upload_form = UploadForm()
 
         if form.validate_on_submit():
             if form.current_version.data == page.current_version:
                 toc, html = wiki_md(group, form.textArea.data)
-                page.update_content(group, form.textArea.data, html, toc)
-                
-                # Make sure wiki page references using raw html are also kept track of.
-                soup = BeautifulSoup(form.textArea.data, 'html.parser')
-                hrefs = [a['href'] for a in soup.find_all('a', class_='wiki-page')]
-                for href in hrefs:
-                    m = href_prog.fullmatch(href)
-                    try:
-                        href_group, href_page_id = m.group(1), m.group(2)
-                        assert group == href_group
-                        href_page = _WikiPage.objects(id=href_page_id).only('id').first()
-                        if href_page:
-                            wiki_md.wiki_refs.append(href_page)
-                    except (AttributeError, AssertionError):
-                        pass
+                try:
+                    page.update_content(group, form.textArea.data, html, toc)
+                except SaveConditionError:
+                    # Its history has just been compacted, see `WikiPage.compact_history`.
+                    pass
+                else:
+                    # Make sure wiki page references using raw html are also kept track of.
+                    soup = BeautifulSoup(form.textArea.data, 'html.parser')
+                    hrefs = [a['href'] for a in soup.find_all('a', class_='wiki-page')]
+                    for href in hrefs:
+                        m = href_prog.fullmatch(href)
+                        try:
+                            href_group, href_page_id = m.group(1), m.group(2)
+                            assert group == href_group
+                            href_page = _WikiPage.objects(id=href_page_id).only('id').first()
+                            if href_page:
+                                wiki_md.wiki_refs.append(href_page)
+                        except (AttributeError, AssertionError):
+                            pass
                 
-                _WikiPage.objects(id=page.id).update(set__refs=wiki_md.wiki_refs,
-                                                     set__files=wiki_md.wiki_files)
-                return redirect(url_for('.wiki_page', group=group, page_id=page_id))
-            else:
-                flash('Other changes have been made to this '
-                      'page since you started editing it.')
+                    page.update_refs(wiki_md.wiki_refs, wiki_md.wiki_files)
+                    return redirect(url_for('.wiki_page', group=group, page_id=page_id))
+            flash('Other changes have been made to this '
+                  'page since you started editing it.')
+    # Links to renamed pages are updated once the page is saved.
+    if page.md:
+        page.md = normalize_wiki_links(group, page.md)
     return wiki_render_template('wiki_page_edit.html', 
                                 group=group, 
                                 page=page, 
@@ -215,10 +407,11 @@ def wiki_do_upload(group):
 
     with switch_db(WikiPage, group) as _WikiPage:
         page_id = form.get('page_id', None)
-        parent_page = _WikiPage.objects.exclude('comments', 'refs').get(id=page_id)
+        parent_page = _WikiPage.objects.exclude('comments', 'refs', 'versions').get(id=page_id)
 
         file_md = ''
         file_html = ''
+        wiki_files = []
         for i, file in enumerate(request.files.getlist("file")):
             # save uploaded file info to database
             wiki_file = WikiFile(name=file.filename,
@@ -240,12 +433,23 @@ def wiki_do_upload(group):
                 file_md += '\n\n[file:{}]'.format(wiki_file.id)
                 file_html += '<p>{}</p>'.\
                     format(render_wiki_file(group, wiki_file.id, wiki_file.name))
-            parent_page.files.append(wiki_file)
-
-        parent_page.update_content(group, 
-                                   parent_page.md+file_md,
-                                   parent_page.html+file_html,
-                                   parent_page.toc)
+            wiki_files.append(wiki_file)
+
+        parent_page.files.extend(wiki_files)
+        try:
+            parent_page.update_content(group, 
+                                       parent_page.md+file_md,
+                                       parent_page.html+file_html,
+                                       parent_page.toc)
+        except SaveConditionError:
+            # Its history has just been compacted, see `WikiPage.compact_history`.
+            # Add the files to the page as it is now.
+            parent_page = _WikiPage.objects.exclude('comments', 'refs', 'versions').get(id=page_id)
+            parent_page.files.extend(wiki_files)
+            parent_page.update_content(group, 
+                                       parent_page.md+file_md,
+                                       parent_page.html+file_html,
+                                       parent_page.toc)
     return ''
 
 
@@ -287,24 +491,32 @@ def wiki_do_upload_from_edit(group):
 @user_required
 def wiki_page_versions(group, page_id):
     with switch_db(WikiPage, group) as _WikiPage:
-        page = _WikiPage.objects.exclude('html', 'comments').get_or_404(id=page_id)
+        page = _WikiPage.objects.exclude('html', 'comments', 'versions').get_or_404(id=page_id)
         if page.current_version == 1:
             return redirect(url_for('.wiki_page', group=group, page_id=page_id))
         form = VersionRecoverForm()
         if form.validate_on_submit():
-            if form.version.data >= page.current_version:
+            if not 1 <= form.version.data < page.current_version:
                 flash('Please enter an old version number.')
             else:
                 recovered_content = page.get_version_content(group, form.version.data)
                 toc, html = wiki_md(group, recovered_content)
-                page.update_content(group, recovered_content, html, toc)
-                _WikiPage.objects(id=page.id).update(add_to_set__refs=wiki_md.wiki_refs,
-                                                     add_to_set__files=wiki_md.wiki_files)
+                try:
+                    page.update_content(group, recovered_content, html, toc)
+                except SaveConditionError:
+                    # Its history has just been compacted, so version numbers may have changed.
+                    flash('The history of this page has just changed, please try again.')
+                    return redirect(url_for('.wiki_page_versions', group=group, page_id=page_id))
+                page.update_refs(wiki_md.wiki_refs, wiki_md.wiki_files, keep=True)
                 return redirect(url_for('.wiki_page', group=group, page_id=page_id))
 
     old_ver_num = request.args.get('version', default=page.current_version - 1, type=int)
+    if not 1 <= old_ver_num < page.current_version:
+        abort(404)
     new_ver_num = old_ver_num + 1
     diff_table = page.make_wikipage_diff(group, old_ver_num, new_ver_num)
+    versions = {v.version: v for v in page.load_versions(group, old_ver_num, new_ver_num + 1,
+                                                         'version', 'modified_on', 'modified_by')}
 
     start_page, end_page = calc_page_num(old_ver_num, page.current_version-1)
 
@@ -315,6 +527,7 @@ def wiki_page_versions(group, page_id):
                                 old_ver_num=old_ver_num, 
                                 new_ver_num=new_ver_num, 
                                 diff_table=diff_table,
+                                versions=versions,
                                 start_page=start_page, 
                                 end_page=end_page,
                                 total_pages=page.current_version-1)
@@ -336,7 +549,13 @@ def wiki_rename_page(group, page_id):
             elif _WikiPage.objects(title=new_title).count() > 0:
                 flash('The new page title has already been taken.')
             else:
-                page.rename(group, new_title)
+                old_title = page.title
+                for displaced_id in page.rename(group, new_title):
+                    wiki_md.invalidate(group, page_id=displaced_id)
+                    wiki_jobs.enqueue('replace_links', group, current_user.name,
+                                      page_id=str(displaced_id), old_title=new_title)
+                wiki_titles.update(group, added=[(page.id, new_title)],
+                                   removed=[(page.id, old_title)])
                 return redirect(url_for('.wiki_page', group=group, page_id=page_id))
 
     return wiki_render_template('wiki_rename_page.html', group=group, page=page, form=form)
@@ -346,14 +565,30 @@ def wiki_rename_page(group, page_id):
 @guest_required
 def wiki_references(group, page_id):
     with switch_db(WikiPage, group) as _WikiPage:
-        page = _WikiPage.objects.only('title').get_or_404(id=page_id)
-        referenced_by = _WikiPage.objects(refs__contains=page_id).\
-            only('id', 'title').all()
-    # The pages which reference `page`
+        page = _WikiPage.objects.only('title', 'backlinks', 'fragment_stamp').get_or_404(id=page_id)
+        cursor = request.args.get('cursor')
+        # The list changes when pages link to `page` or not any more, or are renamed.
+        key = fragment_key(page.id, 'references', page.fragment_stamp, page.backlinks, 
+                           wiki_titles.stamp(group), cursor)
+        fragments = wiki_fragments.get(group, key) if wiki_fragments is not None else None
+        if fragments is None:
+            # The pages which reference `page`
+            try:
+                referenced_by = paginate_queryset(_WikiPage.objects(refs=page.id).only('id', 'title'),
+                                                  [('id', 1)], 100, cursor)
+            except ValueError:
+                abort(400)
+            referenced_by.total = page.backlinks
+            fragments = {'list': render_template('_wiki_references_list.html', 
+                                                 group=group, 
+                                                 page=page, 
+                                                 referenced_by=referenced_by)}
+            if wiki_fragments is not None:
+                wiki_fragments.set(group, key, page.id, fragments)
     return wiki_render_template('wiki_references.html', 
                                 group=group, 
                                 page=page,
-                                referenced_by=referenced_by)
+                                fragments=fragments)
 
 
 @main.route('/<group>/file/<int:file_id>')
@@ -1,17 +1,23 @@
 from collections import OrderedDict
 from datetime import datetime
 from flask_login import UserMixin, AnonymousUserMixin, current_user
-from mongoengine.context_managers import switch_db
+from mongoengine.context_managers import switch_db, no_dereference
+from mongoengine.queryset.visitor import Q
+from mongoengine.errors import SaveConditionError
 from markdown.util import etree
+from bson import ObjectId
+import bisect
 import difflib
+import time
 
-from . import db, login_manager, wiki_pwd
+from . import db, login_manager, wiki_pwd, config
 from .wiki_util import unified_diff
+from .wiki_util.compression import CompressedStringField, contains_query
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return WikiUser.objects(id=user_id).first()
+    return WikiUser.load_cached(user_id)
 
 
 class Permission:
@@ -29,6 +35,9 @@ roles = OrderedDict([
     ('Guest', Permission.READ)
 ])
 
+# Compares titles ignoring case, see the index `title_ci` of `WikiPage`
+title_collation = {'locale': 'en', 'strength': 2}
+
 
 class AnonymousUser(AnonymousUserMixin):
     id = ''
@@ -66,9 +75,51 @@ class WikiUser(UserMixin, db.Document):
 
     meta = {'collection': 'wiki_user'}
 
+    # Users cached by this process, by id: (time loaded, user)
+    cached = {}
+    # When `WikiUserStamp` was last checked by this process, and its stamp then
+    cached_stamp = (None, None)
+
     def __repr__(self):
         return '<User {}>'.format(self.name)
 
+    @classmethod
+    def load_cached(cls, user_id):
+        """Load a user, from the cache of this process if possible.
+        
+        A user is cached for up to `USER_CACHE_TTL` seconds. Every 
+        `USER_STAMP_INTERVAL` seconds, `WikiUserStamp` is checked, and if 
+        any user has been changed since, by any process, the cache is cleared.
+        
+        :param user_id: user id, as stored in the session
+        """
+        now = time.monotonic()
+        checked_on, stamp = cls.cached_stamp
+        if checked_on is None or now - checked_on >= config.USER_STAMP_INTERVAL:
+            latest = WikiUserStamp.objects.first()
+            latest = latest.stamp if latest is not None else None
+            if latest != stamp:
+                cls.cached.clear()
+            cls.cached_stamp = (now, latest)
+
+        loaded_on, user = cls.cached.get(user_id, (None, None))
+        if loaded_on is None or now - loaded_on >= config.USER_CACHE_TTL:
+            user = cls.objects(id=user_id).first()
+            if user is None:
+                cls.cached.pop(user_id, None)
+            else:
+                cls.cached[user_id] = (now, user)
+        return user
+
+    @classmethod
+    def forget_cached(cls):
+        """Make every process load users from database again. 
+        Should be called after permissions, passwords or membership 
+        of existing users have been saved.
+        """
+        WikiUserStamp.objects.update_one(set__stamp=ObjectId(), upsert=True)
+        cls.cached.clear()
+
     def set_password(self, password):
         self.password_hash = wiki_pwd.hash(password)
 
@@ -85,6 +136,8 @@ class WikiUser(UserMixin, db.Document):
             Admin: Add/remove users in the group, read/write pages.
             User: Read/write pages.
             Guest: Read pages. 
+        
+        Call `forget_cached` once the user is saved.
         """
         self.permissions[group] = roles[role]
 
@@ -112,6 +165,14 @@ class WikiUser(UserMixin, db.Document):
             and (self.permissions['super'] & Permission.SUPER) == Permission.SUPER
 
 
+class WikiUserStamp(db.Document):
+    """A single document, renewed whenever users are changed, 
+    see `WikiUser.load_cached`."""
+    stamp = db.ObjectIdField()
+
+    meta = {'collection': 'wiki_user_stamp'}
+
+
 class WikiFile(db.Document):
     """Collection of uploaded files.
     
@@ -150,81 +211,145 @@ class WikiFile(db.Document):
 class WikiPageVersion(db.Document):
     """Collection of page versions.
     
+    :param page_id: id of the page this is a version of
+    :param history_id: the history of the page this version belongs to, 
+        see `WikiPage.history_id`
     :param diff: differences between two adjacent versions
     :param version: version number
     :param modified_on: the time when this version of page is modified
     :param modified_by: username of the one who modified the wiki page
+    :param keyframe: full markdown of this version, only stored periodically
+        (see `is_keyframe_due`) so that recovering an old version starts
+        from the nearest keyframe instead of the current page.
     """
-    diff = db.StringField()
+    page_id = db.ObjectIdField()
+    history_id = db.ObjectIdField()
+    diff = CompressedStringField()
     version = db.IntField()
     modified_on = db.DateTimeField()
     modified_by = db.StringField()
+    keyframe = CompressedStringField()
 
     def __repr__(self):
         return '<Version {}>'.format(self.version)
 
+    @staticmethod
+    def recover(md, versions):
+        """Recover the content of the oldest version in `versions`.
+
+        :param md: markdown of the version right after the newest one in `versions`
+        :param versions: adjacent versions, oldest first
+            Only the versions up to the first keyframe are used.
+        """
+        patches = []
+        for v in versions:
+            if v.keyframe is not None:
+                md = v.keyframe
+                break
+            patches.append(v.diff)
+        return unified_diff.apply_patches(md, patches[::-1], revert=True)
+
     meta = {
         'collection': 'wiki_page_version',
-        'indexes': [{
+        'indexes': [('page_id', 'version'), {
             'fields': ['$diff'],
             'default_language': 'english'
         }]
     }
 
 
-class WikiComment(db.EmbeddedDocument):
+class WikiComment(db.Document):
     """Comment, once submitted, can be deleted by author or admin, 
     but cannot be modified. 
     Comment accepts the same kind of markdown used to edit wiki pages.
     In addition, when one can enter `[@user1]`, Project Wiki will send 
     out a notification email to `user1`.
     
-    :param id: comment id
+    Comments are kept apart from their page, so that a page commented 
+    on at length stays small, and are shown a page at a time, latest first.
+    
+    :param page_id: id of the page commented on
     :param timestamp: the time comment is submitted
     :param author: username of comment author
     :param html: html rendered from entered markdown
     :param md: submitted markdown
     """
-    # id = <epoch time>-<author id>
-    id = db.StringField(required=True)
+    page_id = db.ObjectIdField(required=True)
     timestamp = db.DateTimeField(default=datetime.now)
     author = db.StringField()
     html = db.StringField()
     md = db.StringField()
 
+    meta = {
+        'collection': 'wiki_comment',
+        'indexes': [('page_id', 'timestamp', 'id'), ('page_id', 'author'), {
+            'fields': ['$md'],
+            'default_language': 'english'
+        }]
+    }
+
 
 class WikiPage(db.Document):
     """Collection of Project Wiki pages.
     
     :param title: page title
+    :param former_titles: titles the page had before being renamed, 
+        which [[links]] written before still refer to
     :param md: page markdown
-    :param html: html rendered from `md`
+    :param html: html rendered from `md`, where the text of the links 
+        to pages is replaced by their current titles when served, 
+        see `wiki_util.title_index.TitleIndex.resolve_links`
     :param toc: table of contents generated based on headings in `md`
     :param current_version: current version number of the page
-    :param versions: a list references to previous versions of the page
+    :param versions: references to the previous versions of the page, 
+        kept by pages saved before `WikiPageVersion.page_id` was added, 
+        until `manage.py backfill_version_pages` drops them
+    :param history_id: id of the current history of the page, renewed when 
+        `compact_history` switches the page to a compacted copy of it; 
+        versions of any other history are ignored until deleted
+    :param keyframes: version numbers of the previous versions storing a keyframe
+    :param keyframe_diff_size: total size of the diffs stored since the latest keyframe
     :param modified_on: the most recent time when page is modified
     :param modified_by: username of the one who modified the page recently
-    :param comments: comments
+    :param comment_count: number of comments, see `WikiComment`
+    :param comments: comments saved in the page before they were moved 
+        to `WikiComment`, see `manage.py migrate_comments`
     :param refs: a list of references to the pages mentioned
     :param files: a list of references to the files mentioned
+    :param backlinks: number of pages mentioning this page, 
+        kept up to date by `update_refs`
+    :param fragment_stamp: renewed whenever the page or its reference page 
+        shows something else, see `wiki_util.fragment_cache`
     """
     title = db.StringField(required=True, unique=True)
-    md = db.StringField()
-    html = db.StringField()
+    former_titles = db.ListField(db.StringField())
+    md = CompressedStringField()
+    html = CompressedStringField()
     toc = db.StringField()
     current_version = db.IntField(default=1)
     versions = db.ListField(db.ReferenceField(WikiPageVersion))
+    history_id = db.ObjectIdField()
+    keyframes = db.ListField(db.IntField())
+    keyframe_diff_size = db.IntField(default=0)
     modified_on = db.DateTimeField(default=datetime.now)
     modified_by = db.StringField()
-    comments = db.ListField(db.EmbeddedDocumentField(WikiComment))
+    comment_count = db.IntField(default=0)
+    comments = db.ListField(db.DictField())
 
     refs = db.ListField(db.ReferenceField('self'))
     files = db.ListField(db.ReferenceField('WikiFile'))
+    backlinks = db.IntField(default=0)
+    fragment_stamp = db.ObjectIdField()
 
     meta = {
         'collection': 'wiki_page',
         'indexes': [
-            '#title', {
+            '#title', 'former_titles', ('-modified_on', '-id'), ('refs', 'id'), 'files', 
+            ('backlinks', 'id'), ('current_version', 'id'), {
+                'fields': ['title'],
+                'name': 'title_ci',
+                'collation': title_collation
+            }, {
                 'fields': ['$title', '$md', '$comments.md'],
                 'default_language': 'english',
                 'weights': {'title': 10, 'md': 2, 'comments.md': 1}
@@ -247,9 +372,17 @@ class WikiPage(db.Document):
         self.toc = toc
         diff = unified_diff.make_patch(self.md, md)
         if diff:
-            pv = WikiPageVersion(diff, self.current_version, self.modified_on,
-                                 self.modified_by).switch_db(group).save()
-            self.versions.append(pv)
+            pv = WikiPageVersion(page_id=self.id, history_id=self.history_id, diff=diff, 
+                                 version=self.current_version, 
+                                 modified_on=self.modified_on, modified_by=self.modified_by)
+            last_keyframe = self.keyframes[-1] if self.keyframes else 0
+            if is_keyframe_due(self.current_version - last_keyframe, self.keyframe_diff_size):
+                pv.keyframe = self.md
+                self.keyframes.append(self.current_version)
+                self.keyframe_diff_size = 0
+            else:
+                self.keyframe_diff_size += len(diff)
+            pv.switch_db(group).save()
             self.md = md
             self.modified_on = datetime.now()
             self.modified_by = current_user.name
@@ -258,42 +391,163 @@ class WikiPage(db.Document):
             with switch_db(WikiCache, group) as _WikiCache:
                 _cache = _WikiCache.objects.only('changes_id_title').first()
                 _cache.add_changed_page(self.id, self.title, self.modified_on)
-        self.save()
+                _WikiCache.forget_sidebar(group)
+        self.fragment_stamp = ObjectId()
+        try:
+            # Unless `compact_history` has switched the page to another history
+            self.save(save_condition={'__raw__': {'history_id': self.history_id}})
+        except SaveConditionError:
+            if diff:
+                pv.delete()
+            raise
+        WikiSearchLog.add(group, self.id)
+
+    def update_refs(self, refs, files, keep=False):
+        """Set the pages and files mentioned by the page, and update 
+        the `backlinks` of the pages it starts or stops mentioning.
+        
+        Should be called within `switch_db(WikiPage, group)`.
+        
+        :param refs: the pages mentioned
+        :param files: the files mentioned
+        :param keep: whether to keep mentioning the pages and files 
+            mentioned before, e.g. when recovering a previous version
+        """
+        ref_ids = list(OrderedDict.fromkeys(p.id for p in refs))
+        if keep:
+            update = {'add_to_set__refs': ref_ids, 'add_to_set__files': files}
+        else:
+            update = {'set__refs': ref_ids, 'set__files': files}
+        # The refs before this very update, even if the page is saved concurrently
+        previous = self.__class__.objects(id=self.id).only('refs').modify(**update)
+        if previous is None:
+            return
+        with no_dereference(self.__class__):
+            previous_ids = {r.id for r in previous.refs}
+        added = [i for i in ref_ids if i not in previous_ids]
+        if added:
+            self.__class__.objects(id__in=added).update(inc__backlinks=1, 
+                                                        set__fragment_stamp=ObjectId())
+        removed = [] if keep else list(previous_ids.difference(ref_ids))
+        if removed:
+            self.__class__.objects(id__in=removed).update(dec__backlinks=1, 
+                                                          set__fragment_stamp=ObjectId())
+
+    @classmethod
+    def empty_stubs(cls):
+        """The pages created by linking to them, which have never been 
+        edited or commented on since, except the homepage.
+        
+        Should be called within `switch_db(WikiPage, group)`.
+        """
+        # Pages saved before `comment_count` was added have none, 
+        # until `manage.py migrate_comments` sets it.
+        no_comments = Q(comment_count=0) | \
+            Q(comment_count__exists=False) & (Q(comments__size=0) | Q(comments__exists=False))
+        return cls.objects(no_comments, current_version=1, md='', title__ne='Home')
 
     def rename(self, group, new_title):
-        """Rename a wikipage, update all the pages which reference it, 
-        as well as WikiPageVersion, WikiCache.
+        """Rename a wikipage, and update WikiCache.
+        
+        The pages which link to it are left as they are: their html links 
+        to the page by id, and the old title is kept in `former_titles` 
+        for their markdown, see `wiki_markdown.find_wiki_pages`.
+        
+        If the new title is a former title of other pages, they lose it, 
+        and the links using it should be changed to their current titles 
+        with `replace_links`.
         
         :param group: group name (no whitespace)
         :param new_title: the new title of the page
+        :return: the ids of the pages whose former title was taken
         """
-        old_md = '[[{}]]'.format(self.title)
-        new_md = '[[{}]]'.format(new_title)
-        
-        old_html = render_wiki_link(group, self.id, self.title)
-        new_html = render_wiki_link(group, self.id, new_title)
-        
         # `switch_db(WikiPage, group)` has already been done in `main.wiki_rename_page`.
-        for p in self.__class__.objects(refs__contains=self.id).exclude('comments').all():
-            p.md = p.md.replace(old_md, new_md)
-            p.html = p.html.replace(old_html, new_html)
-            p.save()
-            
-        with switch_db(WikiPageVersion, group) as _WikiPageVersion:
-            for pv in _WikiPageVersion.objects.search_text(old_md).all():
-                pv.diff = pv.diff.replace(old_md, new_md)
-                pv.save()
+        displaced = [p.id for p in self.__class__.objects(id__ne=self.id, former_titles=new_title).
+                     only('id')]
+        self.__class__.objects(former_titles=new_title).update(pull__former_titles=new_title)
+
         with switch_db(WikiCache, group) as _WikiCache:
             _WikiCache.objects(changes_id_title=[self.id, self.title]).\
-                update(set__changes_id_title__S=[self.id, new_title])
+                update(set__changes_id_title__S=[self.id, new_title],
+                       set__sidebar_stamp=ObjectId())
             _WikiCache.objects(keypages_id_title=[self.id, self.title]).\
-                update(set__keypages_id_title__S=[self.id, new_title])
+                update(set__keypages_id_title__S=[self.id, new_title],
+                       set__sidebar_stamp=ObjectId())
+            _WikiCache.forget_sidebar(group)
 
+        self.__class__.objects(id=self.id).update_one(set__title=new_title,
+                                                      add_to_set__former_titles=self.title,
+                                                      set__fragment_stamp=ObjectId())
         self.title = new_title
-        self.save()
+        WikiSearchLog.add(group, self.id)
+        return displaced
 
-    def get_version_content(self, group, old_ver_num):
-        """Recover an old version of the page. 
+    def replace_links(self, group, old_title, new_title):
+        """Change [[old_title]] to [[new_title]] in the markdown and history 
+        of the pages linking to this one. Their html is left as it is, 
+        since it links to this page by id.
+        
+        Should be called within `switch_db(WikiPage, group)`.
+        
+        :param group: group name (no whitespace)
+        :return: the ids of the pages changed
+        """
+        old_md = '[[{}]]'.format(old_title)
+        new_md = '[[{}]]'.format(new_title)
+        changed_ids = []
+        # Compressed markdown is matched once loaded.
+        for p in self.__class__.objects(refs=self.id, __raw__=contains_query('md', old_md)).only('id', 'md'):
+            if old_md in p.md:
+                self.__class__.objects(id=p.id).update_one(set__md=p.md.replace(old_md, new_md))
+                changed_ids.append(p.id)
+        with switch_db(WikiPageVersion, group) as _WikiPageVersion:
+            # The diffs must still apply to the markdown changed.
+            for pv in _WikiPageVersion.objects(page_id__in=changed_ids, 
+                                               __raw__=contains_query('diff', old_md)):
+                if old_md in pv.diff:
+                    pv.diff = pv.diff.replace(old_md, new_md)
+                    pv.save()
+            for pv in _WikiPageVersion.objects(page_id__in=changed_ids, 
+                                               __raw__=contains_query('keyframe', old_md)):
+                if old_md in pv.keyframe:
+                    pv.keyframe = pv.keyframe.replace(old_md, new_md)
+                    pv.save()
+        return changed_ids
+
+    def load_versions(self, group, start_ver_num, end_ver_num, *fields):
+        """Load the versions from `start_ver_num` up to, but not including, 
+        `end_ver_num` with a single range query, oldest first, 
+        from the history `history_id` of the page.
+        
+        :param group: group name (no whitespace)
+        :param start_ver_num: the oldest version number
+        :param end_ver_num: the version number after the newest one
+        :param fields: the fields of WikiPageVersion to load
+        :return: a list of versions
+        """
+        with switch_db(WikiPageVersion, group) as _WikiPageVersion:
+            # Raw, since pages never compacted have no history id, and match missing ones.
+            in_range = {'version__gte': start_ver_num, 'version__lt': end_ver_num, 
+                        '__raw__': {'history_id': self.history_id}}
+            versions = list(_WikiPageVersion.objects(page_id=self.id, **in_range).\
+                only(*fields).order_by('version'))
+            # The current version is the page itself.
+            if len(versions) < min(end_ver_num, self.current_version) - start_ver_num:
+                # Versions saved before `page_id` was added, 
+                # found by the references the page still keeps.
+                with switch_db(WikiPage, group) as _WikiPage:
+                    page = _WikiPage.objects(id=self.id).only('versions').first()
+                    with no_dereference(_WikiPage):
+                        refs = page.versions if page else None
+                version_ids = [v.id for v in refs or []]
+                if version_ids:
+                    versions = list(_WikiPageVersion.objects(Q(page_id=self.id) | Q(id__in=version_ids), 
+                                                             **in_range).\
+                        only(*fields).order_by('version'))
+        return versions
+
+    def get_version_contents(self, group, *ver_nums):
+        """Recover old versions of the page. 
         Because WikiPageVersion only stores the unified diff between two adjecent 
         versions, to get a really old version it needs to apply the difference 
         one by one. 
@@ -302,16 +556,143 @@ class WikiPage(db.Document):
             page.content[version 10] + diff[version 9] -> page.content[version 9]
             page.content[version  9] + diff[version 8] -> page.content[version 8]
             page.content[version  8] + diff[version 7] -> page.content[version 7]
-        So it took longer to calculate what the content of an old version is than 
-        a newer version.
+        To keep this bounded, a full copy of the page is stored every so often 
+        (see `is_keyframe_due`), and the diffs are applied starting from the 
+        nearest keyframe newer than the old version, if there is one.
+        All the diffs needed are loaded with one query, and each version is 
+        recovered from the next newer one requested.
+        
+        :param group: group name (no whitespace)
+        :param ver_nums: the old version numbers, from 1 to `current_version`
+        :return: a list of markdown, in the same order as `ver_nums`
+        """
+        oldest = min(ver_nums)
+        if oldest < 1 or max(ver_nums) > self.current_version:
+            raise ValueError('No version {} of page {}'.format(
+                oldest if oldest < 1 else max(ver_nums), self.id))
+        i = bisect.bisect_left(self.keyframes, max(ver_nums))
+        newer_ver_num = self.keyframes[i] if i < len(self.keyframes) else self.current_version
+        versions = {}
+        if oldest < self.current_version:
+            versions = {v.version: v for v in self.load_versions(group, oldest, newer_ver_num + 1,
+                                                                 'version', 'diff', 'keyframe')}
+        contents = {}
+        md, end = self.md, min(newer_ver_num + 1, self.current_version)
+        for ver_num in sorted(set(ver_nums), reverse=True):
+            if ver_num < self.current_version:
+                try:
+                    chain = [versions[n] for n in range(ver_num, end)]
+                except KeyError as e:
+                    raise ValueError('Version {} of page {} is missing'.format(e.args[0], self.id))
+                md = WikiPageVersion.recover(md, chain)
+                end = ver_num
+            contents[ver_num] = md
+        return [contents[ver_num] for ver_num in ver_nums]
+
+    def get_version_content(self, group, old_ver_num):
+        """Recover an old version of the page, see `get_version_contents`.
         
         :param group: group name (no whitespace)
         :param old_ver_num: the old version number
         """
-        with switch_db(WikiPageVersion, group):
-            old_to_current = self.versions[(old_ver_num - 1):]
-            old_to_current_patches = [v.diff for v in old_to_current[::-1]]
-            return unified_diff.apply_patches(self.md, old_to_current_patches, revert=True)
+        return self.get_version_contents(group, old_ver_num)[0]
+
+    def rebuild_keyframes(self, group):
+        """Store keyframes in the history of a page, e.g. one created 
+        before keyframes were introduced. Existing keyframes are replaced.
+        
+        :param group: group name (no whitespace)
+        """
+        md = self.md
+        keyframes = []
+        keyframe_diff_size = diff_size = 0
+        newer_keyframe = self.current_version
+        versions = list(self.load_versions(group, 1, self.current_version,
+                                           'version', 'diff', 'keyframe'))
+        with switch_db(WikiPageVersion, group) as _WikiPageVersion:
+            for pv in versions[::-1]:
+                md = unified_diff.apply_patch(md, pv.diff, revert=True)
+                if is_keyframe_due(newer_keyframe - pv.version, diff_size):
+                    if not keyframes:
+                        keyframe_diff_size = diff_size
+                    keyframes.append(pv.version)
+                    newer_keyframe = pv.version
+                    diff_size = 0
+                    _WikiPageVersion.objects(id=pv.id).update_one(set__keyframe=md)
+                else:
+                    diff_size += len(pv.diff)
+                    if pv.keyframe is not None:
+                        _WikiPageVersion.objects(id=pv.id).update_one(unset__keyframe=True)
+        if not keyframes:
+            keyframe_diff_size = diff_size
+        self.__class__.objects(id=self.id).update_one(set__keyframes=keyframes[::-1],
+                                                      set__keyframe_diff_size=keyframe_diff_size)
+
+    def compact_history(self, group, before):
+        """Keep only the last version of each day among the versions made 
+        before `before`, as well as the first version. The diff of a version 
+        dropped is merged into the diff of the version before it, and the 
+        versions left are renumbered.
+        
+        The compacted history is written as new versions, and the page is 
+        switched to it by a single update, given up if the page has been 
+        modified in the meantime. Until then, the history of the page is 
+        left as it is, so that a compaction stopped halfway changes nothing 
+        but the versions to be deleted by the next one.
+        
+        :param group: group name (no whitespace)
+        :param before: the time before which versions are compacted
+        :return: the number of versions dropped
+        """
+        versions = list(self.load_versions(group, 1, self.current_version, 'version', 'diff', 
+                                           'keyframe', 'modified_on', 'modified_by'))
+        modified_on = [v.modified_on for v in versions] + [self.modified_on]
+        runs = []
+        for i, v in enumerate(versions):
+            if runs and modified_on[i] < before \
+                    and modified_on[i].date() == modified_on[i + 1].date():
+                runs[-1].append(v)
+            else:
+                runs.append([v])
+        if len(runs) == len(versions):
+            return 0
+
+        history_id = ObjectId()
+        compacted = []
+        keyframes, keyframe_diff_size = [], 0
+        for ver_num, run in enumerate(runs, 1):
+            pv = WikiPageVersion(page_id=self.id, history_id=history_id, version=ver_num,
+                                 diff=run[0].diff, keyframe=run[0].keyframe,
+                                 modified_on=run[0].modified_on, modified_by=run[0].modified_by)
+            if len(run) > 1:
+                if pv.keyframe is None and any(v.keyframe is not None for v in run):
+                    # Move a keyframe dropped with its version to the start of the run.
+                    pv.keyframe = WikiPageVersion.recover(None, run)
+                pv.diff = unified_diff.compose_patches([v.diff for v in run])
+            if pv.keyframe is not None:
+                keyframes.append(ver_num)
+                keyframe_diff_size = 0
+            else:
+                keyframe_diff_size += len(pv.diff)
+            compacted.append(pv)
+
+        with switch_db(WikiPageVersion, group) as _WikiPageVersion:
+            _WikiPageVersion.objects.insert(compacted, load_bulk=False)
+            if not self.__class__.objects(id=self.id, current_version=self.current_version, 
+                                          __raw__={'history_id': self.history_id}).\
+                    update_one(set__history_id=history_id,
+                               unset__versions=True,
+                               set__current_version=len(runs) + 1,
+                               set__keyframes=keyframes,
+                               set__keyframe_diff_size=keyframe_diff_size):
+                # The page has been modified in the meantime.
+                _WikiPageVersion.objects(history_id=history_id).delete()
+                return 0
+            # The previous history, and those left by compactions stopped halfway
+            _WikiPageVersion.objects(Q(page_id=self.id, history_id__ne=history_id) | 
+                                     Q(id__in=[v.id for v in versions])).delete()
+        self.history_id = history_id
+        return len(versions) - len(runs)
 
     def make_wikipage_diff(self, group, old_ver_num, new_ver_num):
         """Generate a table to compare differences between two different 
@@ -321,8 +702,7 @@ class WikiPage(db.Document):
         :param old_ver_num: old version number
         :param new_ver_num: new version number
         """
-        old_content = self.get_version_content(group, old_ver_num)
-        new_content = self.get_version_content(group, new_ver_num)
+        old_content, new_content = self.get_version_contents(group, old_ver_num, new_ver_num)
         d = difflib.HtmlDiff()
         diff_table = d.make_table(old_content.splitlines(), new_content.splitlines())
         diff_table = diff_table.replace('&nbsp;', ' ').replace(' nowrap="nowrap"', '')
@@ -334,13 +714,70 @@ class WikiCache(db.Document):
     
     :param keypages_id_title: keypage ids and titles
     :param changes_id_title: recently changed page ids and titles
+    :param render_stamp: bumped whenever cached renders of this group 
+        may have gone stale, see `wiki_util.render_cache`
+    :param sidebar_stamp: renewed whenever keypages or changes are modified, 
+        so that a sidebar cached by any process can be revalidated cheaply
+    :param titles_stamp: renewed whenever pages are created, renamed or deleted, 
+        see `wiki_util.title_index`
     """
     keypages_id_title = db.ListField()
     changes_id_title = db.ListField()
     latest_change_time = db.DateTimeField(default=datetime.now)
+    render_stamp = db.IntField(default=0)
+    sidebar_stamp = db.ObjectIdField()
+    titles_stamp = db.ObjectIdField()
 
     meta = {'collection': 'wiki_cache'}
 
+    # Sidebars cached by this process, by group: (time checked, stamp, sidebar)
+    sidebars = {}
+
+    @classmethod
+    def load_sidebar(cls, group):
+        """Keypages, the 5 latest changes (latest first) and the time of the 
+        latest change, to be shown in the sidebar.
+        
+        A sidebar cached less than `SIDEBAR_CACHE_TTL` seconds ago is used 
+        as it is. An older one is used if `sidebar_stamp` has not changed. 
+        So changes made by other processes show up within the TTL.
+        
+        Should be called within `switch_db(WikiCache, group)`.
+        
+        :param group: group name (no whitespace)
+        """
+        now = time.monotonic()
+        checked_on, stamp, sidebar = cls.sidebars.get(group, (None, None, None))
+        if checked_on is not None and now - checked_on < config.SIDEBAR_CACHE_TTL:
+            return sidebar
+        
+        latest = cls.objects.only('sidebar_stamp').first()
+        if sidebar is None or latest.sidebar_stamp != stamp:
+            _cache = cls.objects.only('keypages_id_title', 'changes_id_title', 
+                                      'latest_change_time', 'sidebar_stamp').\
+                fields(slice__changes_id_title=-5).first()
+            stamp = _cache.sidebar_stamp
+            sidebar = (_cache.keypages_id_title, 
+                       _cache.changes_id_title[::-1], 
+                       _cache.latest_change_time)
+        cls.sidebars[group] = (now, stamp, sidebar)
+        return sidebar
+
+    @classmethod
+    def loaded_sidebar_stamp(cls, group):
+        """The stamp of the sidebar `load_sidebar` returns, which may be 
+        older than `sidebar_stamp` for `SIDEBAR_CACHE_TTL` seconds.
+        
+        Should be called within `switch_db(WikiCache, group)`.
+        """
+        cls.load_sidebar(group)
+        return cls.sidebars[group][1]
+
+    @classmethod
+    def forget_sidebar(cls, group):
+        """Drop the sidebar cached by this process, after changing it."""
+        cls.sidebars.pop(group, None)
+
     def update_keypages(self, group, *titles):
         self.keypages_id_title = []
         with switch_db(WikiPage, group) as _WikiPage:
@@ -352,21 +789,103 @@ class WikiCache(db.Document):
             # Deduplicate keypages and keep the original order
             self.keypages_id_title = sorted(set(self.keypages_id_title),
                                             key=self.keypages_id_title.index)
+        self.sidebar_stamp = ObjectId()
         self.save()
+        self.forget_sidebar(group)
 
     def add_changed_page(self, page_id, page_title, page_time):
-        page_id_title = [page_id, page_title]
+        self.add_changed_pages([(page_id, page_title, page_time)])
+
+    def add_changed_pages(self, changes):
+        """Add changed pages, oldest change first, and save only once.
+        
+        :param changes: a list of (page id, page title, change time)
+        """
         if not self.changes_id_title:
             self.changes_id_title = []
-        self.changes_id_title = list(filter(lambda x:x != page_id_title, 
-                                            self.changes_id_title))
-        self.changes_id_title.append(page_id_title)
+        for page_id, page_title, page_time in changes:
+            page_id_title = [page_id, page_title]
+            self.changes_id_title = list(filter(lambda x:x != page_id_title, 
+                                                self.changes_id_title))
+            self.changes_id_title.append(page_id_title)
+            self.latest_change_time = page_time
         if len(self.changes_id_title) > 50:
             self.changes_id_title = self.changes_id_title[-50:]
-        self.latest_change_time = page_time
+        self.sidebar_stamp = ObjectId()
         self.save()
 
 
+class WikiRenderCache(db.Document):
+    """Rendered markdown shared by all the workers, 
+    see `wiki_util.render_cache.MongoRenderCache`.
+    
+    :param key: hash of the markdown and the renderer version
+    :param refs: ids of the pages linked to
+    :param files: ids of the files embedded
+    :param mentions: ids of the users mentioned
+    """
+    key = db.StringField(primary_key=True)
+    toc = db.StringField()
+    html = db.StringField()
+    refs = db.ListField(db.ObjectIdField())
+    files = db.ListField(db.IntField())
+    mentions = db.ListField(db.ObjectIdField())
+    last_used = db.DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'wiki_render_cache',
+        'indexes': ['refs', 'files', 'last_used']
+    }
+
+
+class WikiFragmentCache(db.Document):
+    """Rendered parts of pages shared by all the workers, 
+    see `wiki_util.fragment_cache.MongoFragmentCache`.
+    
+    :param key: hash of what the parts depend on, see `fragment_cache.fragment_key`
+    :param page_id: id of the page the parts belong to
+    :param fragments: html of each part, by name
+    """
+    key = db.StringField(primary_key=True)
+    page_id = db.ObjectIdField()
+    fragments = db.DictField()
+    last_used = db.DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'wiki_fragment_cache',
+        'indexes': ['page_id', 'last_used']
+    }
+
+
+class WikiSearchLog(db.Document):
+    """Pages whose title, markdown or comments have changed, or which 
+    have been deleted, so that the search index kept by each process 
+    can catch up, see `wiki_util.search.BM25Search`.
+    
+    :param page_id: id of the page changed
+    :param logged_on: the time the change is logged
+    """
+    page_id = db.ObjectIdField()
+    logged_on = db.DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'wiki_search_log',
+        'indexes': [{
+            'fields': ['logged_on'],
+            'expireAfterSeconds': config.SEARCH_LOG_RETENTION_DAYS * 24 * 3600
+        }]
+    }
+
+    @classmethod
+    def add(cls, group, *page_ids):
+        """Log changed pages, unless there is no search index to update."""
+        if config.SEARCH_BACKEND == 'text' or not page_ids:
+            return
+        with switch_db(cls, group) as _WikiSearchLog:
+            _WikiSearchLog.objects.insert([_WikiSearchLog(page_id=i) for i in page_ids], 
+                                          load_bulk=False)
+
+
 class WikiGroup(db.Document):
     """Collection of Project Wiki groups.
     
@@ -390,9 +909,66 @@ class WikiLoginRecord(db.Document):
 
     meta = {
         'collection': 'wiki_login_record',
-        'ordering': ['-timestamp']
+        'ordering': ['-timestamp'],
+        'indexes': [('username', '-timestamp'), ('-timestamp', '-id')]
+    }
+    if config.LOGIN_RECORD_RETENTION_DAYS:
+        meta['indexes'].append({
+            'fields': ['timestamp'],
+            'expireAfterSeconds': config.LOGIN_RECORD_RETENTION_DAYS * 24 * 3600
+        })
+
+
+class WikiJob(db.Document):
+    """Work done in the background, see `wiki_util.jobs.JobQueue`.
+    
+    :param kind: which handler runs the job
+    :param group: group name (no whitespace) of the group concerned
+    :param params: arguments of the handler
+    :param created_by: username of the one who queued the job
+    :param status: `queued`, `running`, `done` or `failed`
+    :param done: number of items done so far
+    :param total: number of items to do, if known
+    :param attempts: number of times the job has been started
+    :param run_after: when a job queued can be started, later when retried
+    :param locked_until: when a job running may be taken over by another 
+        worker, extended whenever progress is reported
+    :param error: the error of the latest attempt which failed
+    """
+    kind = db.StringField(required=True)
+    group = db.StringField()
+    params = db.DictField()
+    status = db.StringField(default='queued')
+    done = db.IntField(default=0)
+    total = db.IntField()
+    attempts = db.IntField(default=0)
+    created_by = db.StringField()
+    created_on = db.DateTimeField(default=datetime.now)
+    run_after = db.DateTimeField(default=datetime.now)
+    started_on = db.DateTimeField()
+    finished_on = db.DateTimeField()
+    locked_until = db.DateTimeField()
+    error = db.StringField()
+
+    meta = {
+        'collection': 'wiki_job',
+        'indexes': [('status', 'run_after'), ('status', 'locked_until'),
+                    ('-created_on', '-id'), ('group', '-created_on', '-id')]
     }
 
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.kind, self.id)
+
+
+def is_keyframe_due(versions_since_keyframe, diff_size_since_keyframe):
+    """Whether the next page version should store a keyframe.
+    
+    :param versions_since_keyframe: number of versions since the latest keyframe
+    :param diff_size_since_keyframe: total size of the diffs stored in between
+    """
+    return versions_since_keyframe >= config.VERSION_KEYFRAME_INTERVAL \
+        or diff_size_since_keyframe >= config.VERSION_KEYFRAME_DIFF_SIZE
+
 
 def render_wiki_link(group, page_id, page_title, tostring=True):
     """Render html """
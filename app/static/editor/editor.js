@@ -106,4 +106,68 @@ var editor = CodeMirror.fromTextArea(document.getElementById('code'), {
 
 editor.on('change', update);
 update(editor);
-editor.focus();
\ No newline at end of file
+editor.focus();
+// Complete page titles after `[[`, looked up in /<group>/titles
+var titleHints = $('<ul class="title-hints"></ul>').appendTo('body').hide();
+var titleTimer = null;
+
+function titlePrefix(){
+	var cur = editor.getCursor();
+	var m = editor.getRange({line: cur.line, ch: 0}, cur).match(/\[\[([^\[\]]*)$/);
+	return m ? m[1] : null;
+}
+
+function closeTitleHints(){
+	titleHints.hide().empty();
+}
+
+function pickTitle(title){
+	var cur = editor.getCursor();
+	var prefix = titlePrefix();
+	if (prefix === null) return closeTitleHints();
+	var close = editor.getLine(cur.line).slice(cur.ch, cur.ch + 2) == ']]' ? '' : ']]';
+	editor.replaceRange(title + close, {line: cur.line, ch: cur.ch - prefix.length}, cur);
+	closeTitleHints();
+	editor.focus();
+}
+
+function showTitleHints(titles){
+	titleHints.empty();
+	if (titles.length == 0) return closeTitleHints();
+	$.each(titles, function(i, title){
+		$('<li></li>').text(title).toggleClass('active', i == 0).appendTo(titleHints)
+			.on('mousedown', function(e){ e.preventDefault(); pickTitle(title); });
+	});
+	var pos = editor.cursorCoords(true, 'page');
+	titleHints.css({left: pos.left, top: pos.bottom}).show();
+}
+
+editor.on('cursorActivity', function(){
+	clearTimeout(titleTimer);
+	var prefix = titlePrefix();
+	if (prefix === null) return closeTitleHints();
+	titleTimer = setTimeout(function(){
+		$.getJSON('/' + wiki_group + '/titles', {prefix: prefix}, function(data){
+			if (titlePrefix() === prefix) showTitleHints(data.titles);
+		});
+	}, 100);
+});
+
+editor.on('keydown', function(cm, e){
+	if (!titleHints.is(':visible')) return;
+	var items = titleHints.children(), i = items.index(items.filter('.active'));
+	if (e.keyCode == 38 || e.keyCode == 40){  // Up, Down
+		i = (i + (e.keyCode == 40 ? 1 : items.length - 1)) % items.length;
+		items.removeClass('active').eq(i).addClass('active');
+	} else if (e.keyCode == 13 || e.keyCode == 9){  // Enter, Tab
+		pickTitle(items.eq(i).text());
+	} else if (e.keyCode == 27){  // Esc closes the hints instead of the editor
+		closeTitleHints();
+		e.stopPropagation();
+	} else {
+		return;
+	}
+	e.preventDefault();
+});
+
+editor.on('blur', closeTitleHints);
@@ -0,0 +1,102 @@
+import re
+import zlib
+from bson import Binary
+from mongoengine.fields import StringField
+from .. import config
+from . import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# BSON binary subtypes of the values compressed with each codec, in the user-defined range
+subtypes = {'zlib': 0x80, 'zstd': 0x81}
+
+
+def check_config(config):
+    """Raise ValueError if `COMPRESSION` cannot be used, and warn
+    that it hides large diffs from history search, and large pages 
+    from the search backend too unless it is BM25.
+    """
+    if config.COMPRESSION and config.COMPRESSION not in subtypes:
+        raise ValueError('Unknown compression: {}'.format(config.COMPRESSION))
+    if config.COMPRESSION == 'zstd' and zstandard is None:
+        raise ValueError('COMPRESSION is zstd, but the zstandard package is not installed')
+    if config.COMPRESSION:
+        # History search uses the text index of `WikiPageVersion` whatever the backend
+        logger.warning('COMPRESSION is on: diffs of at least {} bytes are never found '
+                       'by searching page history'.format(config.COMPRESSION_THRESHOLD))
+    if config.COMPRESSION and config.SEARCH_BACKEND == 'text':
+        logger.warning('COMPRESSION is on with SEARCH_BACKEND text: pages of at least '
+                       '{} bytes are left out of search results, use SEARCH_BACKEND bm25 '
+                       'to search them'.format(config.COMPRESSION_THRESHOLD))
+
+
+def compress(data, codec):
+    """:param data: bytes
+    :param codec: 'zlib' or 'zstd'
+    :return: a `Binary` of the subtype of `codec`
+    """
+    if codec == 'zstd':
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        compressed = zlib.compress(data)
+    return Binary(compressed, subtypes[codec])
+
+
+def decompress(value):
+    """:param value: a `Binary` made by `compress`
+    :return: bytes
+    """
+    if value.subtype == subtypes['zstd']:
+        if zstandard is None:
+            raise ValueError('Values compressed with zstd need the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(value)
+    return zlib.decompress(value)
+
+
+def is_compressed(value):
+    return isinstance(value, Binary) and value.subtype in subtypes.values()
+
+
+def contains_query(db_field, text):
+    """Raw query of the documents whose field contains `text`, or is compressed
+    and may contain it, which is to be checked once they are loaded.
+
+    :param db_field: database field name
+    """
+    return {'$or': [{db_field: {'$regex': re.escape(text)}},
+                    {db_field: {'$type': 'binData'}}]}
+
+
+class CompressedStringField(StringField):
+    """A string stored compressed with the codec set by `COMPRESSION`, once
+    its utf-8 encoding is at least `COMPRESSION_THRESHOLD` bytes long.
+
+    Values are read back whichever the codec they were stored with,
+    and strings stored as they are, e.g. before compression was turned on,
+    are read as they are. Compressed values are not covered by text indexes,
+    nor matched by queries on their content, see `contains_query`.
+    """
+    def to_mongo(self, value):
+        if not config.COMPRESSION or not isinstance(value, str):
+            return value
+        data = value.encode('utf-8')
+        if len(data) < config.COMPRESSION_THRESHOLD:
+            return value
+        compressed = compress(data, config.COMPRESSION)
+        # Not worth it, e.g. already compressed data pasted as text
+        return compressed if len(compressed) < len(data) else value
+
+    def to_python(self, value):
+        if is_compressed(value):
+            return decompress(value).decode('utf-8')
+        return super().to_python(value)
+
+    def prepare_query_value(self, op, value):
+        # Values set by updates are stored like saved ones.
+        if op == 'set':
+            return self.to_mongo(value)
+        return super().prepare_query_value(op, value)
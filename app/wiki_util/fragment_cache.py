@@ -0,0 +1,105 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from mongoengine.context_managers import switch_db
+from ..models import WikiFragmentCache
+
+
+def from_config(config):
+    """Create the fragment cache chosen by `FRAGMENT_CACHE_BACKEND`,
+    or return None if pages should be rendered every time.
+    """
+    if config.FRAGMENT_CACHE_BACKEND == 'memory':
+        return MemoryFragmentCache(config.FRAGMENT_CACHE_SIZE)
+    elif config.FRAGMENT_CACHE_BACKEND == 'mongo':
+        return MongoFragmentCache(config.FRAGMENT_CACHE_SIZE)
+    elif config.FRAGMENT_CACHE_BACKEND:
+        raise ValueError('Unknown fragment cache backend: {}'.format(config.FRAGMENT_CACHE_BACKEND))
+    return None
+
+
+def fragment_key(page_id, view, *parts):
+    """Key of the parts of a view of a page.
+
+    Keys embed `WikiPage.fragment_stamp`, which is renewed whenever
+    the page shows something else, so entries rendered before can
+    no longer be hit by any process, and are evicted in time.
+
+    :param page_id: id of the page
+    :param view: name of the view, e.g. 'page' or 'references'
+    :param parts: whatever else the parts depend on, e.g. the stamp
+    """
+    return hashlib.sha1(repr((page_id, view) + parts).encode()).hexdigest()
+
+
+class MemoryFragmentCache:
+    """LRU cache of rendered parts of pages in the memory of this process.
+
+    :param size: max number of entries kept
+    """
+    def __init__(self, size):
+        self.size = size
+        # (group, key): (page id, fragments)
+        self.entries = OrderedDict()
+        # Entries are used and evicted by the threads serving requests.
+        self.lock = threading.Lock()
+
+    def get(self, group, key):
+        with self.lock:
+            entry = self.entries.get((group, key))
+            if entry is None:
+                return None
+            self.entries.move_to_end((group, key))
+            return entry[1]
+
+    def set(self, group, key, page_id, fragments):
+        with self.lock:
+            self.entries[(group, key)] = (page_id, fragments)
+            self.entries.move_to_end((group, key))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, group, page_ids):
+        page_ids = set(page_ids)
+        with self.lock:
+            for k in [k for k, (page_id, _) in self.entries.items()
+                      if k[0] == group and page_id in page_ids]:
+                del self.entries[k]
+
+
+class MongoFragmentCache:
+    """LRU cache of rendered parts of pages in the `wiki_fragment_cache`
+    collection of each group, shared by all the processes.
+
+    :param size: max number of entries kept per group
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def get(self, group, key):
+        with switch_db(WikiFragmentCache, group) as _WikiFragmentCache:
+            # Fetch the entry and mark it as recently used in one round trip.
+            entry = _WikiFragmentCache.objects(key=key).\
+                modify(set__last_used=datetime.now())
+        if entry is None:
+            return None
+        return entry.fragments
+
+    def set(self, group, key, page_id, fragments):
+        with switch_db(WikiFragmentCache, group) as _WikiFragmentCache:
+            _WikiFragmentCache(key=key, page_id=page_id, fragments=fragments).save()
+            excess = _WikiFragmentCache.objects.count() - self.size
+            if excess > 0:
+                oldest = _WikiFragmentCache.objects.order_by('last_used').only('key').limit(excess)
+                _WikiFragmentCache.objects(key__in=[e.key for e in oldest]).delete()
+
+    def invalidate(self, group, page_ids):
+        """Drop the entries of pages deleted. Entries of pages changed
+        are not hit any more, see `fragment_key`, and need not be dropped.
+
+        :param group: group name (no whitespace)
+        :param page_ids: ids of the pages
+        """
+        with switch_db(WikiFragmentCache, group) as _WikiFragmentCache:
+            _WikiFragmentCache.objects(page_id__in=list(page_ids)).delete()
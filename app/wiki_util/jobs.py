@@ -0,0 +1,147 @@
+import threading
+from datetime import datetime, timedelta
+from mongoengine.connection import _connection_settings as db_connection_settings
+from mongoengine.queryset.visitor import Q
+from . import logger
+from .. import db, config
+from ..models import WikiJob
+
+
+class JobQueue:
+    """Queue of jobs kept in `WikiJob`, shared by all the processes.
+
+    Each kind of job is run by a handler registered with `handler`,
+    which reports its progress with `progress`. Handlers must be idempotent:
+    a job which fails is started again later, and a job whose worker
+    stopped reporting progress (e.g. the process was restarted) is started
+    again by another worker, both from the beginning.
+
+    :param workers: number of threads of this process running jobs,
+        started when this process serves its first request or queues a job
+    :param lease: seconds a job running is left to its worker after
+        its latest progress
+    :param max_attempts: number of times a job is started before
+        it is given up
+    """
+    # Seconds waited between looking for jobs queued by other processes
+    poll_interval = 5
+    # Seconds waited before starting a job again after it failed, times the attempts
+    retry_delay = 30
+
+    def __init__(self, workers, lease, max_attempts):
+        self.workers = workers
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.handlers = {}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def handler(self, kind):
+        """Register the handler of a kind of job, called with the `WikiJob`."""
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    def enqueue(self, kind, group=None, created_by=None, **params):
+        """Queue a job, and wake up a worker of this process.
+
+        :param kind: which handler runs the job
+        :param group: group name (no whitespace) of the group concerned
+        :param params: arguments of the handler, saved as they are
+        """
+        job = WikiJob(kind=kind, group=group, params=params, created_by=created_by).save()
+        self.start()
+        self.wake.set()
+        return job
+
+    def retry(self, job_id):
+        """Queue a job which failed again, with all its attempts."""
+        WikiJob.objects(id=job_id, status='failed').\
+            update_one(set__status='queued', set__attempts=0, set__run_after=datetime.now())
+        self.start()
+        self.wake.set()
+
+    def start(self):
+        with self.lock:
+            # Started here rather than in `__init__`, since
+            # the processes forked by Gunicorn do not inherit threads.
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def claim(self):
+        """Mark the oldest job which can be started as running, and return it."""
+        now = datetime.now()
+        return WikiJob.objects(Q(status='queued', run_after__lte=now) |
+                               Q(status='running', locked_until__lt=now)).\
+            order_by('created_on').\
+            modify(new=True,
+                   set__status='running',
+                   set__started_on=now,
+                   set__locked_until=now + self.lease,
+                   inc__attempts=1)
+
+    def progress(self, job, done, total=None):
+        """Report the progress of a job, which also extends its lease.
+
+        :param done: number of items done so far
+        :param total: number of items to do, if known
+        """
+        update = {'set__done': done, 'set__locked_until': datetime.now() + self.lease}
+        if total is not None:
+            update['set__total'] = total
+        WikiJob.objects(id=job.id).update_one(**update)
+
+    def run_next(self):
+        """Run the oldest job which can be started, if any.
+
+        :return: False if there was none
+        """
+        job = self.claim()
+        if job is None:
+            return False
+        if job.attempts > self.max_attempts:
+            # Its workers kept stopping, e.g. the job makes the process crash.
+            WikiJob.objects(id=job.id).update_one(
+                set__status='failed', set__finished_on=datetime.now(),
+                set__error='Given up after {} attempts'.format(self.max_attempts))
+            return True
+        if job.group and job.group not in db_connection_settings:
+            # A group created after this process started
+            db.register_connection(alias=job.group, name=job.group,
+                                   host=config.MONGODB_SETTINGS['host'],
+                                   port=config.MONGODB_SETTINGS['port'])
+        try:
+            self.handlers[job.kind](job)
+        except Exception as e:
+            logger.exception('Job {} ({}) failed, attempt {}'.format(job.id, job.kind, job.attempts))
+            if job.attempts < self.max_attempts:
+                WikiJob.objects(id=job.id).update_one(
+                    set__status='queued', set__error=repr(e),
+                    set__run_after=datetime.now() + timedelta(seconds=self.retry_delay * job.attempts))
+            else:
+                WikiJob.objects(id=job.id).update_one(
+                    set__status='failed', set__error=repr(e), set__finished_on=datetime.now())
+        else:
+            WikiJob.objects(id=job.id).update_one(set__status='done', set__finished_on=datetime.now())
+        return True
+
+    def run(self, forever=True):
+        """Run jobs as they are queued by any process.
+
+        :param forever: if False, return once no job can be started
+        """
+        while True:
+            try:
+                while self.run_next():
+                    pass
+            except Exception:
+                # E.g. the database is unreachable, try again later.
+                logger.exception('Failed to look for jobs')
+            if not forever:
+                return
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
@@ -0,0 +1,50 @@
+import atexit
+import threading
+from . import logger
+from ..models import WikiLoginRecord
+
+
+class LoginRecordBuffer:
+    """Queue login records in memory and save them in batches, 
+    so that logging in does not wait for a write.
+    
+    The queue is saved once it holds `batch_size` records, 
+    `interval` seconds after the first record is queued, 
+    and when the process exits.
+    
+    :param batch_size: max number of records queued
+    :param interval: max number of seconds a record is queued
+    """
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.records = []
+        self.lock = threading.Lock()
+        self.timer = None
+        atexit.register(self.flush)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            full = len(self.records) >= self.batch_size
+            if not full and self.timer is None:
+                # Started here rather than in `__init__`, since 
+                # the processes forked by Gunicorn do not inherit threads.
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Save the records queued with a single insert."""
+        with self.lock:
+            records, self.records = self.records, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if records:
+            try:
+                WikiLoginRecord.objects.insert(records, load_bulk=False)
+            except Exception:
+                logger.exception('Failed to save {} login records'.format(len(records)))
@@ -1,3 +1,10 @@
+import threading
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from bson import BSON, SON
+
+
 def calc_page_num(current_page, total_page):
     """
     Default the max page shown being 9.
@@ -15,3 +22,187 @@ def calc_page_num(current_page, total_page):
         start_page, end_page = current_page - 3, current_page + 3
 
     return start_page, end_page
+
+
+class CursorPage:
+    """One page of a listing paginated with `paginate_queryset` or `paginate_pipeline`.
+    
+    :param items: documents (or dicts) on this page
+    :param page: page number, counted from the first page
+    :param prev_cursor: cursor of the previous page, None on the first page
+    :param next_cursor: cursor of the next page, None on the last page
+    :param total: number of items in all the pages, possibly estimated
+    """
+    def __init__(self, items, page, per_page, prev_cursor, next_cursor, total=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return max(1, (self.total + self.per_page - 1) // self.per_page)
+
+
+def encode_cursor(values, page, backward=False):
+    """Make an opaque cursor from the sort key of an item.
+    
+    :param values: values of the sort keys of the last item before the page
+        (or the first item after it if `backward`), or None to start 
+        from the first item
+    :param page: number of the page the cursor leads to
+    """
+    son = BSON.encode({'v': None if values is None else list(values), 'p': page, 'b': backward})
+    return urlsafe_b64encode(son).decode()
+
+
+def decode_cursor(cursor):
+    """:return: values, page, backward; raise ValueError if `cursor` is invalid"""
+    try:
+        son = BSON(urlsafe_b64decode(cursor.encode())).decode()
+        return son['v'], son['p'], son['b']
+    except Exception:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def keyset_filter(sort_keys, values, backward=False):
+    """A filter for the documents after `values` in the order of `sort_keys`, 
+    or before them if `backward`.
+    
+    :param sort_keys: (database field name, 1 or -1), the last one being unique
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort_keys):
+        clause = {k: v for (k, _), v in zip(sort_keys[:i], values)}
+        clause[key] = {'$gt' if (direction > 0) != backward else '$lt': values[i]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
+def _paginate(fetch, get_values, sort_keys, per_page, cursor):
+    values, page, backward = None, 1, False
+    if cursor:
+        values, page, backward = decode_cursor(cursor)
+    keyset = keyset_filter(sort_keys, values, backward) if values is not None else {}
+    items = fetch(keyset, backward, per_page + 1)
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backward:
+        items.reverse()
+    
+    has_prev = has_more if backward else page > 1
+    has_next = True if backward else has_more
+    prev_cursor, next_cursor = None, None
+    if items and has_prev:
+        prev_cursor = encode_cursor(get_values(items[0]), page - 1, True)
+    if items and has_next:
+        next_cursor = encode_cursor(get_values(items[-1]), page + 1, False)
+    return CursorPage(items, page, per_page, prev_cursor, next_cursor)
+
+
+def paginate_queryset(queryset, sort_keys, per_page, cursor=None):
+    """Paginate a queryset by a cursor rather than by skipping, 
+    so that a deep page is as fast as the first one.
+    
+    :param sort_keys: (field name, 1 or -1), the last one being unique, e.g. 
+        `[('modified_on', -1), ('id', -1)]`, ideally matching an index
+    :param cursor: `prev_cursor` or `next_cursor` of another page, 
+        or None for the first page
+    :return: a `CursorPage` of documents
+    """
+    fields = queryset._document._fields
+
+    def fetch(keyset, backward, limit):
+        ordering = ['{}{}'.format('-' if (d < 0) != backward else '', k) for k, d in sort_keys]
+        return list(queryset.filter(__raw__=keyset).order_by(*ordering).limit(limit))
+
+    return _paginate(fetch, lambda item: [item[k] for k, _ in sort_keys],
+                     [(fields[k].db_field, d) for k, d in sort_keys], per_page, cursor)
+
+
+def paginate_pipeline(queryset, pipeline, sort_keys, per_page, cursor=None):
+    """Like `paginate_queryset`, for sort keys computed by an aggregation 
+    `pipeline`, e.g. a text search score.
+    
+    :param sort_keys: (database field name, 1 or -1) of the documents 
+        coming out of `pipeline`
+    :return: a `CursorPage` of dicts
+    """
+    def fetch(keyset, backward, limit):
+        stages = list(pipeline)
+        if keyset:
+            stages.append({'$match': keyset})
+        stages += [{'$sort': SON([(k, -d if backward else d) for k, d in sort_keys])}, 
+                   {'$limit': limit}]
+        return list(queryset.aggregate(*stages))
+
+    return _paginate(fetch, lambda item: [item[k] for k, _ in sort_keys], 
+                     sort_keys, per_page, cursor)
+
+
+def paginate_text_search(queryset, keyword, fields, per_page, cursor=None, **match):
+    """Paginate the results of a text search, best match first.
+    
+    :param queryset: the unfiltered queryset of a collection with a text index
+    :param fields: fields of the documents to load
+    :param match: more conditions on the documents, in database field names
+    :return: a `CursorPage` of documents
+    """
+    document = queryset._document
+    pipeline = [
+        {'$match': dict({'$text': {'$search': keyword}}, **match)},
+        {'$project': dict({document._fields[f].db_field: 1 for f in fields},
+                          score={'$meta': 'textScore'})}
+    ]
+    results = paginate_pipeline(queryset, pipeline, [('score', -1), ('_id', 1)], per_page, cursor)
+    for i, item in enumerate(results.items):
+        item.pop('score')
+        results.items[i] = document._from_son(item)
+    return results
+
+
+# Counts kept by this process, by key: (time counted, count)
+_counts = OrderedDict()
+_counting = set()
+_counts_lock = threading.Lock()
+
+
+def cached_count(key, queryset, ttl, max_size=1000):
+    """Count the documents of a queryset, at most every `ttl` seconds. 
+    Once stale, the previous count is still returned, 
+    while it is counted again in the background.
+    
+    :param key: hashable key of the queryset, e.g. (group, search keyword)
+    """
+    with _counts_lock:
+        counted_on, count = _counts.get(key, (None, None))
+        stale = counted_on is None or time.monotonic() - counted_on >= ttl
+        if stale and count is not None and key not in _counting:
+            _counting.add(key)
+            # Clone, since the queryset may still be iterated by the caller.
+            threading.Thread(target=_count_in_background, 
+                             args=(key, queryset.clone(), max_size), daemon=True).start()
+    if count is None:
+        count = queryset.count()
+        _store_count(key, count, max_size)
+    return count
+
+
+def _count_in_background(key, queryset, max_size):
+    try:
+        _store_count(key, queryset.count(), max_size)
+    finally:
+        with _counts_lock:
+            _counting.discard(key)
+
+
+def _store_count(key, count, max_size):
+    with _counts_lock:
+        _counts[key] = (time.monotonic(), count)
+        _counts.move_to_end(key)
+        while len(_counts) > max_size:
+            _counts.popitem(last=False)
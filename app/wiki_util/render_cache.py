@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from mongoengine.context_managers import switch_db
+from ..models import WikiCache, WikiRenderCache
+
+
+# What `WikiMarkdown` needs to skip a conversion:
+# refs, files and mentions are lists of page, file and user ids.
+RenderedMarkdown = namedtuple('RenderedMarkdown', ['toc', 'html', 'refs', 'files', 'mentions'])
+
+
+def from_config(config):
+    """Create the render cache chosen by `RENDER_CACHE_BACKEND`,
+    or return None if rendered markdown should not be cached.
+    """
+    if config.RENDER_CACHE_BACKEND == 'memory':
+        return MemoryRenderCache(config.RENDER_CACHE_SIZE, config.RENDER_STAMP_TTL)
+    elif config.RENDER_CACHE_BACKEND == 'mongo':
+        return MongoRenderCache(config.RENDER_CACHE_SIZE)
+    elif config.RENDER_CACHE_BACKEND:
+        raise ValueError('Unknown render cache backend: {}'.format(config.RENDER_CACHE_BACKEND))
+    return None
+
+
+class MemoryRenderCache:
+    """LRU cache of rendered markdown in the memory of this process.
+
+    Other processes cannot see which entries this one drops, so
+    `invalidate` bumps `WikiCache.render_stamp` instead, and every key
+    embeds the stamp current when it was made. Entries from before
+    the bump can no longer be hit, and are evicted in time.
+
+    :param size: max number of entries kept
+    :param stamp_ttl: seconds the stamp of a group is reused before 
+        it is read again, so that bumps by other processes show up
+    """
+    def __init__(self, size, stamp_ttl):
+        self.size = size
+        self.stamp_ttl = stamp_ttl
+        self.entries = OrderedDict()
+        # Entries are used and evicted by the threads serving requests.
+        self.lock = threading.Lock()
+        # Stamps read by group: (time read, id of `WikiCache`, render stamp)
+        self.stamps = {}
+
+    def key(self, group, digest):
+        """
+        :param group: group name (no whitespace)
+        :param digest: hash of the markdown and the renderer version
+        """
+        now = time.monotonic()
+        read_on, cache_id, stamp = self.stamps.get(group, (None, None, None))
+        if read_on is None or now - read_on >= self.stamp_ttl:
+            with switch_db(WikiCache, group) as _WikiCache:
+                # The id tells apart a group deleted and created again with the same name.
+                _cache = _WikiCache.objects.only('id', 'render_stamp').first()
+            cache_id, stamp = _cache.id, _cache.render_stamp
+            self.stamps[group] = (now, cache_id, stamp)
+        return group, cache_id, stamp, digest
+
+    def get(self, group, key):
+        with self.lock:
+            rendered = self.entries.get(key)
+            if rendered is not None:
+                self.entries.move_to_end(key)
+            return rendered
+
+    def set(self, group, key, rendered):
+        with self.lock:
+            self.entries[key] = rendered
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, group, page_id=None, file_id=None, page_ids=()):
+        with switch_db(WikiCache, group) as _WikiCache:
+            _WikiCache.objects.update_one(inc__render_stamp=1)
+        # Read the new stamp at once in this process
+        self.stamps.pop(group, None)
+
+
+class MongoRenderCache:
+    """LRU cache of rendered markdown in the `wiki_render_cache` collection
+    of each group, shared by all the processes.
+
+    :param size: max number of entries kept per group
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def key(self, group, digest):
+        return digest
+
+    def get(self, group, key):
+        with switch_db(WikiRenderCache, group) as _WikiRenderCache:
+            # Fetch the entry and mark it as recently used in one round trip.
+            entry = _WikiRenderCache.objects(key=key).\
+                modify(set__last_used=datetime.now())
+        if entry is None:
+            return None
+        return RenderedMarkdown(entry.toc, entry.html, entry.refs, entry.files, entry.mentions)
+
+    def set(self, group, key, rendered):
+        with switch_db(WikiRenderCache, group) as _WikiRenderCache:
+            _WikiRenderCache(key=key, **rendered._asdict()).save()
+            excess = _WikiRenderCache.objects.count() - self.size
+            if excess > 0:
+                oldest = _WikiRenderCache.objects.order_by('last_used').only('key').limit(excess)
+                _WikiRenderCache.objects(key__in=[e.key for e in oldest]).delete()
+
+    def invalidate(self, group, page_id=None, file_id=None, page_ids=()):
+        """Drop the entries which link to a page or embed a file.
+
+        :param group: group name (no whitespace)
+        :param page_id: id of a page renamed or deleted
+        :param file_id: id of a file deleted
+        :param page_ids: ids of pages deleted together
+        """
+        page_ids = list(page_ids) + ([page_id] if page_id is not None else [])
+        with switch_db(WikiRenderCache, group) as _WikiRenderCache:
+            if page_ids:
+                _WikiRenderCache.objects(refs__in=page_ids).delete()
+            if file_id is not None:
+                _WikiRenderCache.objects(files=file_id).delete()
@@ -0,0 +1,410 @@
+import math
+import os
+import pickle
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask import Markup, escape
+from mongoengine.context_managers import switch_db
+from ..models import WikiPage, WikiPageVersion, WikiComment, WikiSearchLog
+from .pagination import CursorPage, encode_cursor, decode_cursor, paginate_text_search
+
+
+# Fields searched and their weights, the same as the text index of `WikiPage`,
+# with the comments of each page from `WikiComment`
+field_weights = [('title', 10), ('md', 2), ('comments', 1)]
+result_fields = ['id', 'title', 'modified_on', 'modified_by', 'md']
+version_fields = ['id', 'page_id', 'history_id', 'version', 'modified_on', 'modified_by', 'diff']
+
+
+def from_config(config):
+    """Create the search backend chosen by `SEARCH_BACKEND`."""
+    if config.SEARCH_BACKEND == 'text':
+        return TextSearch(config.SEARCH_MAX_RESULTS)
+    elif config.SEARCH_BACKEND == 'bm25':
+        return BM25Search(config.SEARCH_INDEX_FOLDER, config.SEARCH_LOG_RETENTION_DAYS)
+    raise ValueError('Unknown search backend: {}'.format(config.SEARCH_BACKEND))
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def parse_query(query):
+    """Split a query the way the text index of MongoDB does,
+    e.g. `wiki "markdown editor" upload* -draft`.
+
+    :return: terms, phrases (lists of terms), prefixes, and excluded terms
+    """
+    terms, phrases, prefixes, excluded = [], [], [], []
+    for phrase in re.findall(r'"([^"]*)"', query):
+        if tokenize(phrase):
+            phrases.append(tokenize(phrase))
+    for word in re.sub(r'"[^"]*"', ' ', query).split():
+        tokens = tokenize(word)
+        if not tokens:
+            continue
+        if word.startswith('-'):
+            excluded += tokens
+        elif word.endswith('*'):
+            terms += tokens[:-1]
+            prefixes.append(tokens[-1])
+        else:
+            terms += tokens
+    return terms, phrases, prefixes, excluded
+
+
+def make_snippet(text, query, width=80):
+    """A piece of `text` around the first match of `query`,
+    with every match highlighted.
+
+    :return: html
+    """
+    terms, phrases, prefixes, _ = parse_query(query)
+    words = set(terms).union(*phrases)
+    patterns = [re.escape(w) + r'\b' for w in words] + [re.escape(p) + r'\w*' for p in prefixes]
+    if not text or not patterns:
+        return Markup('')
+    regex = re.compile(r'\b(?:{})'.format('|'.join(patterns)), re.IGNORECASE)
+
+    first = regex.search(text)
+    start = max(0, first.start() - width) if first else 0
+    end = min(len(text), first.end() + width) if first else 2 * width
+    window = text[start:end]
+    snippet = [Markup('&hellip;')] if start > 0 else []
+    last = 0
+    for m in regex.finditer(window):
+        snippet += [escape(window[last:m.start()]),
+                    Markup('<mark>{}</mark>').format(m.group())]
+        last = m.end()
+    snippet.append(escape(window[last:]))
+    if end < len(text):
+        snippet.append(Markup('&hellip;'))
+    return Markup('').join(snippet)
+
+
+def paginate_ranked(group, ranked, query, per_page, cursor=None):
+    """Paginate pages ranked by a search backend, with the same keyset 
+    as in `pagination.paginate_queryset`, on (score, page id).
+
+    :param ranked: a list of (score, page id), best match first
+    :param query: search keywords, highlighted in the snippets
+    :return: a `CursorPage` of pages, with html snippets by page id in `snippets`
+    """
+    values, page, backward = decode_cursor(cursor) if cursor else (None, 1, False)
+    keys = [(-score, page_id) for score, page_id in ranked]
+    if values is None:
+        start, end = 0, per_page
+    elif backward:
+        end = bisect_left(keys, (-values[0], values[1]))
+        start = max(0, end - per_page)
+    else:
+        start = bisect_right(keys, (-values[0], values[1]))
+        end = start + per_page
+    ranked_page = ranked[start:end]
+
+    page_ids = [page_id for _, page_id in ranked_page]
+    with switch_db(WikiPage, group) as _WikiPage:
+        pages = {p.id: p for p in _WikiPage.objects(id__in=page_ids).only(*result_fields)}
+    prev_cursor, next_cursor = None, None
+    if ranked_page and start > 0:
+        prev_cursor = encode_cursor(list(ranked_page[0]), page - 1, True)
+    if ranked_page and end < len(ranked):
+        next_cursor = encode_cursor(list(ranked_page[-1]), page + 1, False)
+    results = CursorPage([pages[i] for i in page_ids if i in pages], page, per_page,
+                         prev_cursor, next_cursor, total=len(ranked))
+    results.snippets = {p.id: make_snippet(p.md, query) for p in results.items}
+    return results
+
+
+def search_history(group, query, per_page, cursor=None):
+    """Search the diffs of previous versions with the text index of 
+    `WikiPageVersion`, whichever the search backend, e.g. to find a page 
+    which used to mention something since removed.
+    
+    :param query: search keywords
+    :param cursor: see `pagination.paginate_queryset`
+    :return: a `CursorPage` of versions, with the titles of their pages 
+        by page id in `titles`, and html snippets by version id in `snippets`
+    """
+    with switch_db(WikiPageVersion, group) as _WikiPageVersion:
+        # Versions saved before `page_id` was added cannot be linked to, 
+        # see `manage.py backfill_version_pages`.
+        results = paginate_text_search(_WikiPageVersion.objects, query, version_fields,
+                                       per_page, cursor, page_id={'$ne': None})
+    with switch_db(WikiPage, group) as _WikiPage:
+        pages = list(_WikiPage.objects(id__in=list({v.page_id for v in results.items})).\
+            only('id', 'title', 'history_id'))
+        results.titles = {p.id: p.title for p in pages}
+    # Leave out the versions of a history compacted since, see `WikiPage.compact_history`.
+    history_ids = {p.id: p.history_id for p in pages}
+    results.items = [v for v in results.items 
+                     if v.page_id in history_ids and v.history_id == history_ids[v.page_id]]
+    results.snippets = {v.id: make_snippet(v.diff, query) for v in results.items}
+    return results
+
+
+class TextSearch:
+    """Search with the text indexes of MongoDB: pages are matched by the 
+    index of `WikiPage`, and by the index of `WikiComment` on their comments.
+    Their scores are added up, the way the index of `WikiPage` did when 
+    it covered comments, which it still does until `manage.py migrate_comments` 
+    moves them.
+    
+    A pipeline can only match one text index, so the scores are added up 
+    here, from the best `max_results` pages matched by each index.
+
+    :param max_results: number of pages ranked for each search
+    """
+    def __init__(self, max_results):
+        self.max_results = max_results
+
+    def search(self, group, query, per_page, cursor=None):
+        """
+        :param query: search keywords
+        :param cursor: see `paginate_ranked`
+        :return: a `CursorPage` of pages, with html snippets by page id in `snippets`
+        """
+        scores = defaultdict(float)
+        with switch_db(WikiPage, group) as _WikiPage:
+            for p in _WikiPage.objects.aggregate(
+                    {'$match': {'$text': {'$search': query}}},
+                    {'$project': {'score': {'$meta': 'textScore'}}},
+                    {'$sort': {'score': -1}},
+                    {'$limit': self.max_results}):
+                scores[p['_id']] += p['score']
+        with switch_db(WikiComment, group) as _WikiComment:
+            for c in _WikiComment.objects.aggregate(
+                    {'$match': {'$text': {'$search': query}}},
+                    {'$project': {'page_id': 1, 'score': {'$meta': 'textScore'}}},
+                    {'$group': {'_id': '$page_id', 'score': {'$sum': '$score'}}},
+                    {'$sort': {'score': -1}},
+                    {'$limit': self.max_results}):
+                scores[c['_id']] += c['score']
+        ranked = sorted(((score, page_id) for page_id, score in scores.items()), 
+                        key=lambda x: (-x[0], x[1]))[:self.max_results]
+        return paginate_ranked(group, ranked, query, per_page, cursor)
+
+    def forget(self, group):
+        pass
+
+
+class BM25Index:
+    """Inverted index of the pages of a group, ranking them with BM25F.
+
+    :param postings: positions of each term in each field of each page,
+        by term and page id
+    :param docs: weighted length and terms of each page, by page id
+    :param synced_on: when changes were last read from `WikiSearchLog`
+    :param applied: ids of the changes applied recently, with their times
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.docs = {}
+        self.total_length = 0
+        self.synced_on = None
+        self.applied = {}
+        # Sorted terms, to look up prefixes, made again after terms are added or removed
+        self.sorted_terms = None
+
+    def add(self, page_id, title, md, comments):
+        self.remove(page_id)
+        positions = {}
+        length = 0
+        for i, (text, (_, weight)) in enumerate(zip([title, md, comments], field_weights)):
+            tokens = tokenize(text or '')
+            length += weight * len(tokens)
+            for pos, t in enumerate(tokens):
+                positions.setdefault(t, ([], [], []))[i].append(pos)
+        for t, p in positions.items():
+            if t not in self.postings:
+                self.sorted_terms = None
+            self.postings[t][page_id] = p
+        self.docs[page_id] = (length, list(positions))
+        self.total_length += length
+
+    def remove(self, page_id):
+        doc = self.docs.pop(page_id, None)
+        if doc is None:
+            return
+        length, terms = doc
+        self.total_length -= length
+        for t in terms:
+            del self.postings[t][page_id]
+            if not self.postings[t]:
+                del self.postings[t]
+                self.sorted_terms = None
+
+    def expand_prefix(self, prefix, limit=200):
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.postings)
+        i = bisect_left(self.sorted_terms, prefix)
+        terms = []
+        while i < len(self.sorted_terms) and len(terms) < limit \
+                and self.sorted_terms[i].startswith(prefix):
+            terms.append(self.sorted_terms[i])
+            i += 1
+        return terms
+
+    def has_phrase(self, page_id, phrase):
+        fields = [self.postings[t][page_id] for t in phrase]
+        for i in range(len(field_weights)):
+            following = [set(f[i]) for f in fields[1:]]
+            for pos in fields[0][i]:
+                if all(pos + k + 1 in p for k, p in enumerate(following)):
+                    return True
+        return False
+
+    def search(self, query):
+        """Pages matching any term or prefix of `query`, and all of its phrases,
+        like the text index of MongoDB.
+
+        :return: a list of (score, page id), best match first
+        """
+        terms, phrases, prefixes, excluded = parse_query(query)
+        if not self.docs:
+            return []
+        for prefix in prefixes:
+            terms += self.expand_prefix(prefix)
+
+        avg_length = self.total_length / len(self.docs) or 1
+        scores = defaultdict(float)
+        for t in set(terms).union(*phrases):
+            postings = self.postings.get(t, {})
+            idf = math.log(1 + (len(self.docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for page_id, fields in postings.items():
+                tf = sum(weight * len(p) for (_, weight), p in zip(field_weights, fields))
+                norm = 1 - self.b + self.b * self.docs[page_id][0] / avg_length
+                scores[page_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+        matches = set(scores)
+        for phrase in phrases:
+            matches = {i for i in matches
+                       if all(i in self.postings.get(t, {}) for t in phrase)
+                       and self.has_phrase(i, phrase)}
+        for t in excluded:
+            matches.difference_update(self.postings.get(t, {}))
+        return sorted(((scores[i], i) for i in matches), key=lambda x: (-x[0], x[1]))
+
+
+class BM25Search:
+    """Search with a `BM25Index` of each group, kept in memory by each process.
+
+    The index of a group is loaded from `folder` when first searched,
+    or built from the database if it is missing or older than the changes
+    logged in `WikiSearchLog`. Before each search, the pages changed since
+    (by any process) are indexed again, and the index is saved again 
+    every `save_interval` seconds of changes synced, so that it never 
+    gets older than the changes logged.
+
+    :param folder: folder of the saved indexes
+    :param retention_days: days changes are kept in `WikiSearchLog`
+    """
+    # Changes logged up to this many seconds before the previous sync are
+    # read again, in case they were saved late.
+    sync_lag = 10
+    save_interval = 3600
+
+    def __init__(self, folder, retention_days):
+        self.folder = folder
+        self.retention = timedelta(days=retention_days)
+        self.indexes = {}
+        self.locks = {}
+        # `synced_on` of the index of each group as saved
+        self.saved_on = {}
+
+    def index_path(self, group):
+        return os.path.join(self.folder, '{}.pickle'.format(group))
+
+    def rebuild(self, group):
+        """Build the index of a group from the database, and save it."""
+        index = BM25Index()
+        # Changes made while building are applied again by the next sync.
+        index.synced_on = datetime.now()
+        comments = self.load_comments(group)
+        with switch_db(WikiPage, group) as _WikiPage:
+            for p in _WikiPage.objects.only('id', 'title', 'md'):
+                index.add(p.id, p.title, p.md, '\n'.join(comments.get(p.id, [])))
+        self.save(group, index)
+        self.indexes[group] = index
+        return index
+
+    def save(self, group, index):
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.index_path(group)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self.saved_on[group] = index.synced_on
+
+    def load(self, group):
+        try:
+            with open(self.index_path(group), 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return self.rebuild(group)
+        if index.synced_on < datetime.now() - self.retention + timedelta(hours=1):
+            # Some changes since may no longer be logged.
+            return self.rebuild(group)
+        self.saved_on[group] = index.synced_on
+        self.indexes[group] = index
+        return index
+
+    def sync(self, group, index):
+        now = datetime.now()
+        since = index.synced_on - timedelta(seconds=self.sync_lag)
+        with switch_db(WikiSearchLog, group) as _WikiSearchLog:
+            changes = [c for c in _WikiSearchLog.objects(logged_on__gte=since)
+                       if c.id not in index.applied]
+        if changes:
+            page_ids = {c.page_id for c in changes}
+            comments = self.load_comments(group, page_ids)
+            with switch_db(WikiPage, group) as _WikiPage:
+                pages = _WikiPage.objects(id__in=list(page_ids)).only('id', 'title', 'md')
+                for p in pages:
+                    index.add(p.id, p.title, p.md, '\n'.join(comments.get(p.id, [])))
+                    page_ids.discard(p.id)
+            # The pages not found have been deleted.
+            for page_id in page_ids:
+                index.remove(page_id)
+            index.applied.update((c.id, c.logged_on) for c in changes)
+        index.synced_on = now
+        index.applied = {i: t for i, t in index.applied.items() if t >= since}
+        if now - self.saved_on.get(group, now) >= timedelta(seconds=self.save_interval):
+            self.save(group, index)
+
+    def load_comments(self, group, page_ids=None):
+        """The markdown of the comments of some pages, or of all the pages.
+
+        :return: lists of markdown by page id
+        """
+        with switch_db(WikiComment, group) as _WikiComment:
+            comments = _WikiComment.objects.only('page_id', 'md')
+            if page_ids is not None:
+                comments = comments.filter(page_id__in=list(page_ids))
+            by_page = defaultdict(list)
+            for c in comments:
+                by_page[c.page_id].append(c.md or '')
+        return by_page
+
+    def search(self, group, query, per_page, cursor=None):
+        """See `TextSearch.search`."""
+        with self.locks.setdefault(group, threading.Lock()):
+            index = self.indexes.get(group) or self.load(group)
+            self.sync(group, index)
+            ranked = index.search(query)
+
+        return paginate_ranked(group, ranked, query, per_page, cursor)
+
+    def forget(self, group):
+        """Drop the index of a deleted group."""
+        self.indexes.pop(group, None)
+        try:
+            os.remove(self.index_path(group))
+        except OSError:
+            pass
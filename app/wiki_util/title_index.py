@@ -0,0 +1,212 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from bson import ObjectId
+from flask import escape
+from mongoengine.context_managers import switch_db
+from . import logger
+from ..models import WikiPage, WikiCache, title_collation
+
+
+# Links to pages as rendered by `models.render_wiki_link`: the tag, page id and text
+link_regex = re.compile(r'(<a class="wiki-page" href="/[^/"]+/([0-9a-f]{24})/page">)(.*?)</a>',
+                        re.DOTALL)
+
+
+class GroupTitles:
+    """Titles of the pages of a group, sorted case-insensitively.
+
+    :param stamp: `WikiCache.titles_stamp` when the titles were loaded
+    :param by_id: titles by page id
+    :param keys: casefolded titles, sorted
+    :param titles: titles, in the same order as `keys`
+    """
+    def __init__(self, stamp, by_id):
+        self.stamp = stamp
+        self.checked_on = time.monotonic()
+        self.by_id = by_id
+        pairs = sorted((t.casefold(), t) for t in by_id.values())
+        self.keys = [k for k, _ in pairs]
+        self.titles = [t for _, t in pairs]
+
+    def add(self, page_id, title):
+        self.by_id[page_id] = title
+        key = title.casefold()
+        i = bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.titles.insert(i, title)
+
+    def remove(self, page_id, title):
+        self.by_id.pop(page_id, None)
+        key = title.casefold()
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.titles[i] == title:
+                del self.keys[i]
+                del self.titles[i]
+                return
+            i += 1
+
+    def complete(self, prefix, limit):
+        key = prefix.casefold()
+        i = bisect_left(self.keys, key)
+        titles = []
+        while i < len(self.keys) and len(titles) < limit and self.keys[i].startswith(key):
+            titles.append(self.titles[i])
+            i += 1
+        return titles
+
+
+class TitleIndex:
+    """Titles of the pages of each group kept in memory by each process,
+    to complete titles by prefix, e.g. [[links]] in the editor, and to show
+    the current titles of the pages linked to.
+
+    The titles of a group are loaded in the background when first needed,
+    meanwhile they are looked up with the case-insensitive index on
+    `WikiPage.title`. Creating, renaming or deleting pages renews
+    `WikiCache.titles_stamp`, and titles loaded before the stamp was renewed
+    by another process are loaded again, which is checked at most
+    every `ttl` seconds.
+
+    :param ttl: seconds the titles loaded are used before checking the stamp
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.groups = {}
+        self.loading = set()
+        self.lock = threading.Lock()
+
+    def loaded(self, group):
+        """The titles of a group loaded by this process, if any and 
+        not known to be out of date. Otherwise they are loaded in the background.
+        """
+        with self.lock:
+            titles = self.groups.get(group)
+        if titles is not None and time.monotonic() - titles.checked_on >= self.ttl:
+            with switch_db(WikiCache, group) as _WikiCache:
+                stamp = _WikiCache.objects.only('titles_stamp').first().titles_stamp
+            with self.lock:
+                if stamp == titles.stamp:
+                    titles.checked_on = time.monotonic()
+                else:
+                    self.groups.pop(group, None)
+                    titles = None
+        if titles is None:
+            self.load_in_background(group)
+        return titles
+
+    def complete(self, group, prefix, limit=10):
+        """Titles starting with `prefix`, ignoring case, in alphabetical order.
+
+        :param group: group name (no whitespace)
+        """
+        titles = self.loaded(group)
+        if titles is None:
+            return self.find(group, prefix, limit)
+        with self.lock:
+            return titles.complete(prefix, limit)
+
+    def resolve_links(self, group, *htmls):
+        """Replace the text of the links to pages in rendered html 
+        with the current titles of the pages, so that renaming a page 
+        does not change the pages linking to it.
+
+        :param group: group name (no whitespace)
+        :param htmls: html rendered by `WikiMarkdown`
+        :return: a list of html, in the same order as `htmls`
+        """
+        page_ids = {ObjectId(m.group(2)) for html in htmls for m in link_regex.finditer(html or '')}
+        if not page_ids:
+            return list(htmls)
+        titles = self.loaded(group)
+        if titles is None:
+            with switch_db(WikiPage, group) as _WikiPage:
+                by_id = {p.id: p.title for p in _WikiPage.objects(id__in=list(page_ids)).only('title')}
+        else:
+            with self.lock:
+                by_id = {i: titles.by_id[i] for i in page_ids if i in titles.by_id}
+
+        def resolve(m):
+            title = by_id.get(ObjectId(m.group(2)))
+            if title is None:
+                return m.group(0)
+            return '{}{}</a>'.format(m.group(1), escape(title))
+        return [link_regex.sub(resolve, html) if html else html for html in htmls]
+
+    def stamp(self, group):
+        """The `WikiCache.titles_stamp` of the titles `resolve_links` uses.
+
+        :param group: group name (no whitespace)
+        """
+        titles = self.loaded(group)
+        if titles is not None:
+            with self.lock:
+                return titles.stamp
+        with switch_db(WikiCache, group) as _WikiCache:
+            return _WikiCache.objects.only('titles_stamp').first().titles_stamp
+
+    def find(self, group, prefix, limit):
+        """Look up titles in the database, see `complete`."""
+        # Compared with the collation of the index, both bounds match case-insensitively.
+        with switch_db(WikiPage, group) as _WikiPage:
+            pages = _WikiPage._get_collection().\
+                find({'title': {'$gte': prefix, '$lt': prefix + '\U0010ffff'}}, {'title': 1},
+                     collation=title_collation).\
+                sort('title', 1).limit(limit)
+            return [p['title'] for p in pages]
+
+    def load_in_background(self, group):
+        with self.lock:
+            if group in self.loading:
+                return
+            self.loading.add(group)
+        threading.Thread(target=self.load, args=(group,), daemon=True).start()
+
+    def load(self, group):
+        try:
+            with switch_db(WikiCache, group) as _WikiCache, \
+                    switch_db(WikiPage, group) as _WikiPage:
+                # Read the stamp first: any change made while loading renews it.
+                stamp = _WikiCache.objects.only('titles_stamp').first().titles_stamp
+                pages = _WikiPage._get_collection().find({}, {'title': 1})
+                titles = GroupTitles(stamp, {p['_id']: p['title'] for p in pages})
+            with self.lock:
+                self.groups[group] = titles
+        except Exception:
+            logger.exception('Failed to load the page titles of {}'.format(group))
+        finally:
+            with self.lock:
+                self.loading.discard(group)
+
+    def update(self, group, added=(), removed=()):
+        """Renew the stamp of a group after pages are created, renamed or
+        deleted, and update the titles loaded by this process.
+
+        :param group: group name (no whitespace)
+        :param added: ids and titles of the pages created, or new titles
+        :param removed: ids and titles of the pages deleted, or old titles
+        """
+        stamp = ObjectId()
+        with switch_db(WikiCache, group) as _WikiCache:
+            previous = _WikiCache.objects.only('titles_stamp').\
+                modify(set__titles_stamp=stamp)
+        with self.lock:
+            titles = self.groups.get(group)
+            if titles is None:
+                return
+            if previous is None or previous.titles_stamp != titles.stamp:
+                # Changed by another process too, load again.
+                del self.groups[group]
+                return
+            for page_id, title in removed:
+                titles.remove(page_id, title)
+            for page_id, title in added:
+                titles.add(page_id, title)
+            titles.stamp = stamp
+
+    def forget(self, group):
+        """Drop the titles of a deleted group."""
+        with self.lock:
+            self.groups.pop(group, None)
@@ -17,10 +17,22 @@ def apply_patch(s, patch, revert=False):
         str_after = apply_patch(str_before, patch)
         str_before = apply_patch(str_after, patch, revert=True)
     """
-    s = s.splitlines(True)
+    return ''.join(_apply_patch_lines(s.splitlines(True), patch, revert))
+
+
+def _apply_patch_lines(s, patch, revert=False):
+    """
+    Same as `apply_patch`, but s is a list of lines, as returned by
+    `str.splitlines(True)`, and so is the result. Unchanged lines are
+    copied by slice, so no string is built line by line.
+    """
     p = patch.splitlines(True)
-    t = ''
+    t = []
     i = sl = 0
+    # The result is only joined into a string at the very end. If a line
+    # without line break (`No newline at end of file`) ends up followed by
+    # another line, re-split the result the way a string would be.
+    resplit = False
     (midx, sign) = (1, '+') if not revert else (3, '-')
     while i < len(p) and p[i].startswith(("---", "+++")):
         i += 1  # skip header lines
@@ -30,7 +42,9 @@ def apply_patch(s, patch, revert=False):
             raise Exception("Cannot process diff")
         i += 1
         l = int(m.group(midx))-1 + (m.group(midx+1) == '0')
-        t += ''.join(s[sl:l])
+        if sl < l:
+            resplit = resplit or _unterminated(t)
+            t.extend(s[sl:l])
         sl = l
         while i < len(p) and p[i][0] != '@':
             if i+1 < len(p) and p[i+1][0] == '\\':
@@ -41,12 +55,22 @@ def apply_patch(s, patch, revert=False):
                 i += 1
             if len(line) > 0:
                 if line[0] == sign or line[0] == ' ':
-                    t += line[1:]
+                    resplit = resplit or _unterminated(t)
+                    t.append(line[1:])
                 sl += (line[0] != sign)
-    t += ''.join(s[sl:])
+    if sl < len(s):
+        resplit = resplit or _unterminated(t)
+        t.extend(s[sl:])
+    if resplit:
+        t = ''.join(t).splitlines(True)
     return t
 
 
+def _unterminated(lines):
+    """Whether the last line in the list has no line break."""
+    return len(lines) > 0 and not lines[-1].endswith('\n')
+
+
 def make_patch(a, b):
     """
     Get unified string diff between two strings. Trims top two lines.
@@ -66,7 +90,143 @@ def make_patch(a, b):
 
 
 def apply_patches(s, patches, revert=False):
+    """
+    Apply a chain of patches to string s, see `apply_patch`.
+    s is only split into lines once, and joined back once.
+    """
+    s = s.splitlines(True)
     for patch in patches:
-        s = apply_patch(s, patch, revert)
-    return s
+        s = _apply_patch_lines(s, patch, revert)
+    return ''.join(s)
+
+
+
+def compose_patches(patches):
+    """
+    Merge a chain of patches into a single equivalent patch, without
+    recovering the strings in between.
+    Returns empty string if the patches cancel out.
+
+    Usage:
+        diff = compose_patches([make_patch(a, b), make_patch(b, c)])
+        # diff works the same as make_patch(a, c)
+    """
+    ops = []
+    for patch in patches:
+        ops = _compose_ops(ops, _patch_ops(patch))
+    return _format_ops(ops)
+
+
+def _patch_ops(patch):
+    """
+    Turn a patch into a list of edit operations on the older string:
+    ('=', n) keeps n lines, ('-', line) removes a line, ('+', line) adds one.
+    """
+    p = patch.splitlines(True)
+    ops = []
+    i = sl = 0
+    while i < len(p) and p[i].startswith(("---", "+++")):
+        i += 1  # skip header lines
+    while i < len(p):
+        m = _hdr_pat.match(p[i])
+        if not m:
+            raise Exception("Cannot process diff")
+        i += 1
+        l = int(m.group(1))-1 + (m.group(2) == '0')
+        if sl < l:
+            ops.append(('=', l - sl))
+        sl = l
+        while i < len(p) and p[i][0] != '@':
+            if i+1 < len(p) and p[i+1][0] == '\\':
+                line = p[i][:-1]
+                i += 2
+            else:
+                line = p[i]
+                i += 1
+            if len(line) > 0:
+                ops.append(('=', 1) if line[0] == ' ' else (line[0], line[1:]))
+                sl += (line[0] != '+')
+    return ops
+
+
+def _compose_ops(first, second):
+    """
+    Compose the edit operations turning a into b, and b into c,
+    into the operations turning a into c.
+    Lines past the end of either list of operations are kept.
+    """
+    def advance(op, ops, n):
+        # Consume n lines of a keep operation.
+        return ('=', op[1] - n) if op[1] > n else next(ops, None)
+
+    ops = []
+    first, second = iter(first), iter(second)
+    x, y = next(first, None), next(second, None)
+    while x is not None or y is not None:
+        if x is not None and x[0] == '-':
+            ops.append(x)
+            x = next(first, None)
+        elif y is not None and y[0] == '+':
+            ops.append(y)
+            y = next(second, None)
+        elif x is None:
+            ops.append(y)
+            y = next(second, None)
+        elif y is None:
+            ops.append(x)
+            x = next(first, None)
+        elif x[0] == '+':
+            # A line added by the first patch is kept or removed again.
+            if y[0] == '=':
+                ops.append(x)
+                y = advance(y, second, 1)
+            else:
+                y = next(second, None)
+            x = next(first, None)
+        elif y[0] == '=':
+            n = min(x[1], y[1])
+            ops.append(('=', n))
+            x, y = advance(x, first, n), advance(y, second, n)
+        else:
+            # A line kept by the first patch is removed by the second.
+            ops.append(y)
+            x, y = advance(x, first, 1), next(second, None)
+    return ops
+
+
+def _format_ops(ops):
+    """Format edit operations as a patch, the same way `make_patch` does."""
+    hunks = []
+    a = b = 0
+    old, new = [], []
+    for op in ops + [('=', 0)]:
+        if op[0] == '-':
+            old.append(op[1])
+        elif op[0] == '+':
+            new.append(op[1])
+        else:
+            # Lines both removed and added again at either end are kept.
+            start = 0
+            while start < min(len(old), len(new)) and old[start] == new[start]:
+                start += 1
+            end = 0
+            while end < min(len(old), len(new)) - start and old[-1-end] == new[-1-end]:
+                end += 1
+            if len(old) != start + end or len(new) != start + end:
+                hunks.append('@@ -{} +{} @@\n'.format(
+                    _format_range(a + start, len(old) - start - end),
+                    _format_range(b + start, len(new) - start - end)))
+                hunks.extend('-' + line for line in old[start:len(old)-end])
+                hunks.extend('+' + line for line in new[start:len(new)-end])
+            a, b = a + len(old) + op[1], b + len(new) + op[1]
+            old, new = [], []
+    return ''.join([d if d[-1] == '\n' else d+'\n'+_no_eol+'\n' for d in hunks])
+
 
+def _format_range(start, length):
+    """Line range of a hunk header, as in `difflib.unified_diff`."""
+    if length == 1:
+        return '{}'.format(start + 1)
+    if not length:
+        return '{},{}'.format(start, length)
+    return '{},{}'.format(start + 1, length)
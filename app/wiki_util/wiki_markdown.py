@@ -1,37 +1,92 @@
+import re
+import hashlib
 import markdown
+import pymdownx
+from bson import ObjectId
 from markdown.inlinepatterns import Pattern
 from markdown.util import etree
 from markdown.extensions import Extension
+from mongoengine import NotUniqueError
 from mongoengine.context_managers import switch_db
 from flask_login import current_user
-from ..models import WikiPage, WikiFile, WikiUser, WikiCache,\
+from ..models import WikiPage, WikiFile, WikiUser, WikiCache, WikiSearchLog,\
     render_wiki_link, render_wiki_file, render_wiki_image
+from .render_cache import RenderedMarkdown
 
 page_regex = r'\[\[(.+?)\]\]'
 file_regex = r'\[(file|image):(\d+)(@(\d+)x(\d+))?\]'
 at_regex = r'\[@(.+?)\]'
+# Fenced code blocks and code spans, whose [[links]] are rendered as they are
+code_regex = r'^[ \t]*(?P<fence>`{3,}|~{3,})[^\n]*\n.*?^[ \t]*(?P=fence)[`~]*[ \t]*$' \
+             r'|(?<!`)(?P<ticks>`+)(?!`).+?(?<!`)(?P=ticks)(?!`)'
+
+# Bump whenever the patterns below render differently, 
+# so that html cached by older code is not used.
+RENDERER_VERSION = '1-{}-{}'.format(markdown.version, pymdownx.version)
+
+
+def find_wiki_pages(group, titles):
+    """Look up pages by title with a single query, or by former title 
+    for the titles not found, since pages are renamed without changing 
+    the [[links]] to them.
+    Pages which do not exist yet are returned unsaved, with an id already 
+    assigned so that they can be linked to before being saved.
+    
+    :param group: group name (no whitespace)
+    :param titles: page titles
+    :return: a dict of pages by title, and the set of titles not found
+    """
+    titles = set(titles)
+    if not titles:
+        return {}, set()
+    with switch_db(WikiPage, group) as _WikiPage:
+        pages = {p.title: p for p in _WikiPage.objects(title__in=list(titles)).only('id', 'title')}
+        if titles - set(pages):
+            renamed = _WikiPage.objects(former_titles__in=list(titles - set(pages))).\
+                only('id', 'title', 'former_titles')
+            for p in renamed:
+                pages.update((t, p) for t in titles.intersection(p.former_titles))
+        new_titles = titles - set(pages)
+        for title in new_titles:
+            pages[title] = _WikiPage(id=ObjectId(), title=title, md='', html='', toc='',
+                                     modified_by=current_user.name)
+    return pages, new_titles
+
+
+def normalize_wiki_links(group, md):
+    """Change the former titles of renamed pages in [[links]] to their 
+    current titles, e.g. before the markdown is edited. Code is left 
+    as it is, since it is shown as it is.
+    
+    :param group: group name (no whitespace)
+    """
+    regex = re.compile(r'(?:{})|{}'.format(code_regex, page_regex), re.DOTALL | re.MULTILINE)
+    links = [m.group(3) for m in regex.finditer(md) if m.group(3) is not None]
+    pages, _ = find_wiki_pages(group, links)
+    return regex.sub(lambda m: '[[{}]]'.format(pages[m.group(3)].title) if m.group(3) in pages 
+                     else m.group(0), md)
 
 
 # Parse wiki page
 class WikiPagePattern(Pattern):
     wiki_group = None
     wiki_refs = []
+    # Pages linked to, by title, looked up before rendering
+    wiki_pages = {}
+    wiki_new_titles = set()
 
     def handleMatch(self, m):
         page_title = m.group(2)
-        # parse comments on wiki pages
-        with switch_db(WikiPage, self.wiki_group) as _WikiPage:
-            _wp = _WikiPage.objects(title=page_title).only('id').first()
-            if _wp is None:
-                _wp = _WikiPage(title=page_title, md='', html='', toc='',\
-                    modified_by=current_user.name).save()
-                with switch_db(WikiCache, self.wiki_group) as _WikiCache:
-                    _cache = _WikiCache.objects.only('changes_id_title').first()
-                    _cache.add_changed_page(_wp.id, _wp.title, _wp.modified_on)
-            self.wiki_refs.append(_wp)
-            
-            return render_wiki_link(self.wiki_group, _wp.id, 
-                                    page_title, tostring=False)
+        if page_title not in self.wiki_pages:
+            # The title was not found in the markdown as is, e.g. it contains escaped characters.
+            pages, new_titles = find_wiki_pages(self.wiki_group, [page_title])
+            self.wiki_pages.update(pages)
+            self.wiki_new_titles |= new_titles
+        _wp = self.wiki_pages[page_title]
+        self.wiki_refs.append(_wp)
+        
+        return render_wiki_link(self.wiki_group, _wp.id, 
+                                _wp.title, tostring=False)
 
 
 class WikiPageExtension(Extension):
@@ -39,17 +94,31 @@ class WikiPageExtension(Extension):
         md.inlinePatterns['wiki_page'] = WikiPagePattern(page_regex)
 
 
+def find_wiki_files(group, file_ids):
+    """Look up files by id with a single query.
+    
+    :param group: group name (no whitespace)
+    :param file_ids: file ids
+    :return: a dict of files by id
+    """
+    file_ids = set(int(i) for i in file_ids)
+    if not file_ids:
+        return {}
+    with switch_db(WikiFile, group) as _WikiFile:
+        return {f.id: f for f in _WikiFile.objects(id__in=list(file_ids)).only('id', 'name')}
+
+
 # Parse wiki file & image
 class WikiFilePattern(Pattern):
     wiki_group = None
     wiki_files = []
+    # Files embedded, by id, looked up before rendering
+    wiki_files_by_id = {}
 
     def handleMatch(self, m):
         _, _, file_type, file_id, wh, w, h = [m.group(i) for i in range(7)]
 
-        # parse comments on wiki pages
-        with switch_db(WikiFile, self.wiki_group) as _WikiFile:
-            _wf = _WikiFile.objects(id=file_id).first()
+        _wf = self.wiki_files_by_id.get(int(file_id))
         if _wf:
             self.wiki_files.append(_wf)
             if file_type == 'image':
@@ -70,16 +139,31 @@ class WikiFileExtension(Extension):
         md.inlinePatterns['wiki_file'] = WikiFilePattern(file_regex)
 
 
+def find_wiki_users(names):
+    """Look up users by name with a single query.
+    
+    :param names: usernames
+    :return: a dict of users by name
+    """
+    names = set(names)
+    if not names:
+        return {}
+    return {u.name: u for u in WikiUser.objects(name__in=list(names)).\
+            only('name', 'email', 'permissions')}
+
+
 # Parse `@` notification in comments
 class WikiAtPattern(Pattern):
     is_wiki_comment = False
     wiki_group = None
     wiki_users = []
+    # Users mentioned, by name, looked up before rendering
+    wiki_users_by_name = {}
 
     def handleMatch(self, m):
         if self.is_wiki_comment:
             username = m.group(2)
-            u = WikiUser.objects(name=username).first()
+            u = self.wiki_users_by_name.get(username)
             if u and self.wiki_group in u.permissions:
                 el = etree.Element('strong')
                 el.text = '[@{}]'.format(username)
@@ -94,26 +178,110 @@ class WikiAtExtension(Extension):
 
 
 class WikiMarkdown(markdown.Markdown):
-    def __init__(self, *args, **kwargs):
+    """
+    :param render_cache: optional cache of rendered markdown, 
+        see `wiki_util.render_cache`
+    :param title_index: optional `wiki_util.title_index.TitleIndex`, 
+        told about the pages created for links to pages which did not exist
+    """
+    def __init__(self, *args, render_cache=None, title_index=None, **kwargs):
         super().__init__(*args, extensions=[WikiPageExtension(), WikiFileExtension(), WikiAtExtension(),
                                             'markdown.extensions.toc', 'pymdownx.github'], **kwargs)
+        self.render_cache = render_cache
+        self.title_index = title_index
 
     def __call__(self, group, md, is_comment=False):
+        if self.render_cache is None:
+            return self.render(group, md, is_comment)
+
+        digest = hashlib.sha1('\0'.join([RENDERER_VERSION, str(is_comment), md]).encode()).hexdigest()
+        key = self.render_cache.key(group, digest)
+        rendered = self.render_cache.get(group, key)
+        if rendered is not None and self.load_rendered(group, md, rendered, is_comment):
+            return rendered.toc, rendered.html
+
+        toc, html = self.render(group, md, is_comment)
+        self.render_cache.set(group, key, RenderedMarkdown(toc, html,
+                                                           [p.id for p in self.wiki_refs],
+                                                           [f.id for f in self.wiki_files],
+                                                           [u.id for u in self.users_to_notify]))
+        return toc, html
+
+    def render(self, group, md, is_comment=False):
         self.inlinePatterns['wiki_page'].wiki_group = group
         self.inlinePatterns['wiki_page'].wiki_refs = []
+        pages, new_titles = find_wiki_pages(group, re.findall(page_regex, md, re.DOTALL))
+        self.inlinePatterns['wiki_page'].wiki_pages = pages
+        self.inlinePatterns['wiki_page'].wiki_new_titles = new_titles
         self.inlinePatterns['wiki_file'].wiki_group = group
         self.inlinePatterns['wiki_file'].wiki_files = []
+        self.inlinePatterns['wiki_file'].wiki_files_by_id = \
+            find_wiki_files(group, [m[1] for m in re.findall(file_regex, md)])
         self.inlinePatterns['wiki_at'].is_wiki_comment = is_comment
         self.inlinePatterns['wiki_at'].wiki_group = group
         self.inlinePatterns['wiki_at'].wiki_users = []
+        self.inlinePatterns['wiki_at'].wiki_users_by_name = \
+            find_wiki_users(re.findall(at_regex, md, re.DOTALL)) if is_comment else {}
 
         try:
             self.toc = ''
             html = super().convert(md)
         except RecursionError:
             html = md
+
+        try:
+            self.save_new_pages(group)
+        except NotUniqueError:
+            # Some of the pages have just been created by someone else, 
+            # so render again with their ids.
+            return self.render(group, md, is_comment)
         return self.toc, html
 
+    def load_rendered(self, group, md, rendered, is_comment):
+        """Set refs, files and mentions as if `rendered` had just been rendered.
+        The users mentioned are looked up again, since they may have 
+        joined or left the group, or changed their emails since.
+        
+        :return: False if the users mentioned are not the same any more, 
+            in which case the markdown must be rendered again
+        """
+        users_by_id = {}
+        if is_comment:
+            users = find_wiki_users(re.findall(at_regex, md, re.DOTALL)).values()
+            users_by_id = {u.id: u for u in users if group in u.permissions}
+            if set(users_by_id) != set(rendered.mentions):
+                return False
+
+        self.inlinePatterns['wiki_page'].wiki_refs = [WikiPage(id=i) for i in rendered.refs]
+        self.inlinePatterns['wiki_file'].wiki_files = [WikiFile(id=i) for i in rendered.files]
+        self.inlinePatterns['wiki_at'].wiki_users = [users_by_id[i] for i in rendered.mentions]
+        self.toc = rendered.toc
+        return True
+
+    def invalidate(self, group, page_id=None, file_id=None, page_ids=()):
+        """Forget what has been rendered with a link to a page or a file,
+        because it has been renamed or deleted.
+        """
+        if self.render_cache is not None:
+            self.render_cache.invalidate(group, page_id=page_id, file_id=file_id, 
+                                         page_ids=page_ids)
+
+    def save_new_pages(self, group):
+        """Save the pages linked to which did not exist, with a single insert."""
+        new_titles = self.inlinePatterns['wiki_page'].wiki_new_titles
+        new_pages = {p.title: p for p in self.wiki_refs if p.title in new_titles}
+        if new_pages:
+            with switch_db(WikiPage, group) as _WikiPage, \
+                    switch_db(WikiCache, group) as _WikiCache:
+                _WikiPage.objects.insert(list(new_pages.values()), load_bulk=False)
+                _cache = _WikiCache.objects.only('changes_id_title').first()
+                _cache.add_changed_pages([(p.id, p.title, p.modified_on) 
+                                          for p in new_pages.values()])
+                _WikiCache.forget_sidebar(group)
+            WikiSearchLog.add(group, *[p.id for p in new_pages.values()])
+            if self.title_index is not None:
+                self.title_index.update(group, added=[(p.id, p.title) for p in new_pages.values()])
+
     def get_refs_and_files(self, group, md):
         self.__call__(group, md)
         return self.inlinePatterns['wiki_page'].wiki_refs, \
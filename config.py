@@ -39,5 +39,85 @@ class Config:
     DATA_FOLDER = 'Project_Wiki_Data'
     UPLOAD_FOLDER = os.path.join(basedir, DATA_FOLDER, 'uploads')
 
+    # Page history keeps a full copy (keyframe) of a page every N versions,
+    # or once the diffs since the last keyframe add up to this many characters,
+    # so that recovering an old version never replays the whole history.
+    VERSION_KEYFRAME_INTERVAL = int(os.environ.get('VERSION_KEYFRAME_INTERVAL', 50))
+    VERSION_KEYFRAME_DIFF_SIZE = int(os.environ.get('VERSION_KEYFRAME_DIFF_SIZE', 200000))
+
+    # Rendered markdown can be cached, either in the memory of each 
+    # process ('memory'), or in the database shared by all the processes 
+    # ('mongo'). Leave empty to render every time. With 'memory', a page 
+    # deleted by another process may still be linked to by cached renders 
+    # for RENDER_STAMP_TTL seconds.
+    RENDER_CACHE_BACKEND = os.environ.get('RENDER_CACHE_BACKEND', '')
+    RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', 1000))
+    RENDER_STAMP_TTL = float(os.environ.get('RENDER_STAMP_TTL', 5))
+
+    # The body of pages and of their reference pages, once rendered, can be 
+    # cached in the memory of each process ('memory') or in the database 
+    # shared by all the processes ('mongo'), keeping up to FRAGMENT_CACHE_SIZE 
+    # entries. Leave empty to render every time.
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'memory')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 500))
+
+    # The markdown, html and history of pages can be stored compressed 
+    # with 'zlib', or 'zstd' once the zstandard package is installed, 
+    # when at least COMPRESSION_THRESHOLD bytes long. Leave empty to store 
+    # them as they are. Values are read back whatever the setting. 
+    # Compressed markdown and diffs are not covered by the text indexes, 
+    # see `python manage.py compression_report`: large pages are then found 
+    # by SEARCH_BACKEND 'bm25' only, and large diffs are never found by 
+    # searching page history, whichever the SEARCH_BACKEND.
+    COMPRESSION = os.environ.get('COMPRESSION', '')
+    COMPRESSION_THRESHOLD = int(os.environ.get('COMPRESSION_THRESHOLD', 4096))
+
+    # Each process reuses the sidebar (keypages and changes) of a group 
+    # for this many seconds before checking whether it has changed.
+    SIDEBAR_CACHE_TTL = float(os.environ.get('SIDEBAR_CACHE_TTL', 5))
+
+    # Each process keeps the page titles of each group in memory to complete 
+    # [[links]], and checks whether they have changed every this many seconds.
+    TITLE_INDEX_TTL = float(os.environ.get('TITLE_INDEX_TTL', 5))
+
+    # Each process caches logged in users for up to USER_CACHE_TTL seconds, 
+    # and checks every USER_STAMP_INTERVAL seconds whether any user has been 
+    # changed (e.g. demoted) by another process.
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+    USER_STAMP_INTERVAL = float(os.environ.get('USER_STAMP_INTERVAL', 2))
+
+    # Login records are queued, and saved once LOGIN_RECORD_BATCH_SIZE are 
+    # queued or LOGIN_RECORD_FLUSH_INTERVAL seconds later, whichever first.
+    # They are deleted by MongoDB after LOGIN_RECORD_RETENTION_DAYS days, 
+    # or kept forever if it is 0. To change the retention of an existing 
+    # database, drop the index `timestamp_1` of `wiki_login_record` first.
+    LOGIN_RECORD_BATCH_SIZE = int(os.environ.get('LOGIN_RECORD_BATCH_SIZE', 50))
+    LOGIN_RECORD_FLUSH_INTERVAL = float(os.environ.get('LOGIN_RECORD_FLUSH_INTERVAL', 10))
+    LOGIN_RECORD_RETENTION_DAYS = int(os.environ.get('LOGIN_RECORD_RETENTION_DAYS', 0))
+
+    # Work fanning out to many documents (e.g. deleting a page or a group) 
+    # is queued in the database, and done by JOB_WORKERS threads of each 
+    # process, or only by `python manage.py run_jobs` if it is 0. A job whose 
+    # worker has not reported progress for JOB_LEASE seconds is started 
+    # again by another worker, up to JOB_MAX_ATTEMPTS times in all.
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+    JOB_LEASE = float(os.environ.get('JOB_LEASE', 300))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+    # Listings show a total count which may be up to this many seconds old.
+    COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 60))
+
+    # Search with the text index of MongoDB ('text'), or with a BM25 index 
+    # kept in memory by each process ('bm25'), which also supports 
+    # "phrases", prefix* and -excluded terms. The BM25 index of each group 
+    # is saved in SEARCH_INDEX_FOLDER and catches up with the changes logged 
+    # in the last SEARCH_LOG_RETENTION_DAYS days, or is built again.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'text')
+    SEARCH_INDEX_FOLDER = os.path.join(basedir, DATA_FOLDER, 'search_index')
+    SEARCH_LOG_RETENTION_DAYS = int(os.environ.get('SEARCH_LOG_RETENTION_DAYS', 7))
+    # With the 'text' backend, only the best SEARCH_MAX_RESULTS pages 
+    # matched by a search are ranked and can be paged through.
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 1000))
+
 
 config = Config()
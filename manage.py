@@ -1,6 +1,17 @@
-from app import create_app, db, wiki_pwd, mail
-from app.models import WikiUser, WikiPage
+import random
+import timeit
+from datetime import datetime, timedelta
+from app import create_app, config, db, wiki_pwd, mail, wiki_search, wiki_jobs, login_manager
+from app.main import views as main_views
+from app.models import WikiUser, WikiPage, WikiPageVersion, WikiComment, WikiGroup, WikiSearchLog, \
+    is_keyframe_due
+from app.wiki_util import unified_diff, compression
+from app.wiki_util.fragment_cache import MemoryFragmentCache
+from app.wiki_util.search import BM25Search
+from bson import ObjectId
 from flask_script import Manager, Shell
+from pymongo import ReplaceOne
+from mongoengine.context_managers import switch_db, no_dereference
 
 app = create_app()
 manager = Manager(app)
@@ -18,5 +29,339 @@ def create_admin():
              password_hash=wiki_pwd.hash(app.config['ADMIN_PASSWORD']),
              permissions={'super': 0xff}).save()
 
+
+def active_groups():
+    return [g.name_no_whitespace for g in WikiGroup.objects(active=True).all()]
+
+
+@manager.command
+def backfill_keyframes():
+    """Store keyframes in the history of existing pages."""
+    for group in active_groups():
+        with switch_db(WikiPage, group) as _WikiPage:
+            pages = _WikiPage.objects.exclude('html', 'toc', 'comments', 'versions', 'refs', 'files').all()
+            for page in pages:
+                page.rebuild_keyframes(group)
+            print('{}: {} pages'.format(group, len(pages)))
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=100,
+                help='Number of pages migrated at once')
+def backfill_version_pages(batch):
+    """Set the page of the versions saved before `WikiPageVersion.page_id` 
+    was added, so that they can be found by searching page history, 
+    then drop the references to them kept by their page, `WikiPage.versions`.
+    Can be stopped and run again."""
+    for group in active_groups():
+        updated = pages_done = 0
+        last_id = None
+        with switch_db(WikiPage, group) as _WikiPage, \
+                switch_db(WikiPageVersion, group) as _WikiPageVersion:
+            while True:
+                pages = _WikiPage.objects(versions__exists=True)
+                if last_id is not None:
+                    pages = pages.filter(id__gt=last_id)
+                pages = list(pages.only('id', 'versions').order_by('id').limit(batch))
+                if not pages:
+                    break
+                last_id = pages[-1].id
+                for page in pages:
+                    with no_dereference(_WikiPage):
+                        version_ids = [v.id for v in page.versions]
+                    updated += _WikiPageVersion.objects(id__in=version_ids, page_id__exists=False).\
+                        update(set__page_id=page.id)
+                    # The versions are found by page from now on, see `WikiPage.load_versions`.
+                    _WikiPage.objects(id=page.id).update_one(unset__versions=True)
+                pages_done += len(pages)
+        print('{}: {} versions updated, {} pages migrated'.format(group, updated, pages_done))
+
+
+@manager.command
+def backfill_backlinks():
+    """Count the pages mentioning each page, see `WikiPage.backlinks`."""
+    for group in active_groups():
+        with switch_db(WikiPage, group) as _WikiPage:
+            # A page mentioning another one more than once counts once.
+            counts = _WikiPage.objects.aggregate(
+                {'$project': {'refs': {'$setUnion': ['$refs', []]}}},
+                {'$unwind': '$refs'},
+                {'$group': {'_id': '$refs', 'count': {'$sum': 1}}})
+            counts = {c['_id']: c['count'] for c in counts}
+            _WikiPage.objects(id__nin=list(counts)).update(set__backlinks=0)
+            for page_id, count in counts.items():
+                _WikiPage.objects(id=page_id).update_one(set__backlinks=count)
+        print('{}: {} pages referenced'.format(group, len(counts)))
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=100,
+                help='Number of pages whose comments are moved at once')
+def migrate_comments(batch):
+    """Move the comments saved in their page to `WikiComment`, and count 
+    the comments of every page. Can be stopped and run again, 
+    the comments moved are not duplicated."""
+    for group in active_groups():
+        moved = 0
+        with switch_db(WikiPage, group) as _WikiPage, \
+                switch_db(WikiComment, group) as _WikiComment:
+            while True:
+                pages = list(_WikiPage.objects(__raw__={'comments.0': {'$exists': True}}).\
+                    only('id', 'comments').limit(batch))
+                if not pages:
+                    break
+                requests = []
+                for page in pages:
+                    for i, c in enumerate(page.comments):
+                        # The same id each time: the time of the comment, the page and its rank.
+                        comment_id = ObjectId(ObjectId.from_datetime(c['timestamp']).binary[:4] +
+                                              page.id.binary[4:9] + i.to_bytes(3, 'big'))
+                        comment = _WikiComment(id=comment_id, page_id=page.id, timestamp=c['timestamp'],
+                                               author=c.get('author'), html=c.get('html'), md=c.get('md'))
+                        requests.append(ReplaceOne({'_id': comment_id}, comment.to_mongo(), upsert=True))
+                if requests:
+                    _WikiComment._get_collection().bulk_write(requests)
+                for page in pages:
+                    _WikiPage.objects(id=page.id).\
+                        update_one(unset__comments=True,
+                                   set__comment_count=_WikiComment.objects(page_id=page.id).count(),
+                                   set__fragment_stamp=ObjectId())
+                WikiSearchLog.add(group, *[p.id for p in pages])
+                moved += len(requests)
+            # The pages which had no comments
+            _WikiPage.objects(comment_count__exists=False).update(set__comment_count=0)
+        print('{}: {} comments moved'.format(group, moved))
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=90,
+                help='Compact the versions older than this many days')
+def compact_history(days):
+    """Keep one version per day in the history older than `days` days."""
+    before = datetime.now() - timedelta(days=days)
+    for group in active_groups():
+        dropped = 0
+        with switch_db(WikiPage, group) as _WikiPage:
+            pages = _WikiPage.objects(current_version__gt=2).\
+                only('id', 'current_version', 'modified_on', 'history_id').all()
+            for page in pages:
+                dropped += page.compact_history(group, before)
+        print('{}: {} versions dropped'.format(group, dropped))
+
+
+@manager.command
+def benchmark_version_recovery():
+    """Time recovering the first version of a page as its history grows, 
+    replaying every diff versus starting from the nearest keyframe."""
+    rnd = random.Random(0)
+    lines = ['line {}\n'.format(i) for i in range(500)]
+    md, versions, keyframes, diff_size = ''.join(lines), [], [], 0
+    print('{:>9} {:>14} {:>14}'.format('versions', 'replay (ms)', 'keyframe (ms)'))
+    for n in (100, 500, 1000, 2000, 4000):
+        while len(versions) < n:
+            lines[rnd.randrange(len(lines))] = 'edit {}\n'.format(len(versions))
+            new_md = ''.join(lines)
+            pv = WikiPageVersion(diff=unified_diff.make_patch(md, new_md),
+                                 version=len(versions) + 1)
+            if is_keyframe_due(pv.version - (keyframes[-1] if keyframes else 0), diff_size):
+                pv.keyframe = md
+                keyframes.append(pv.version)
+                diff_size = 0
+            else:
+                diff_size += len(pv.diff)
+            versions.append(pv)
+            md = new_md
+
+        def replay():
+            return unified_diff.apply_patches(md, [v.diff for v in versions[::-1]], revert=True)
+
+        def from_keyframe():
+            return WikiPageVersion.recover(md, versions)
+
+        assert replay() == from_keyframe()
+        print('{:>9} {:>14.2f} {:>14.2f}'.format(
+            n, min(timeit.repeat(replay, number=1, repeat=3)) * 1000,
+            min(timeit.repeat(from_keyframe, number=1, repeat=3)) * 1000))
+
+
+def apply_patch_concat(s, patch, revert=False):
+    """The patch engine `unified_diff.apply_patch` replaced, which builds 
+    the result with string concatenation, kept for `benchmark_apply_patches`."""
+    s = s.splitlines(True)
+    p = patch.splitlines(True)
+    t = ''
+    i = sl = 0
+    (midx, sign) = (1, '+') if not revert else (3, '-')
+    while i < len(p) and p[i].startswith(('---', '+++')):
+        i += 1
+    while i < len(p):
+        m = unified_diff._hdr_pat.match(p[i])
+        i += 1
+        l = int(m.group(midx))-1 + (m.group(midx+1) == '0')
+        t += ''.join(s[sl:l])
+        sl = l
+        while i < len(p) and p[i][0] != '@':
+            if i+1 < len(p) and p[i+1][0] == '\\':
+                line = p[i][:-1]
+                i += 2
+            else:
+                line = p[i]
+                i += 1
+            if len(line) > 0:
+                if line[0] == sign or line[0] == ' ':
+                    t += line[1:]
+                sl += (line[0] != sign)
+    t += ''.join(s[sl:])
+    return t
+
+
+@manager.command
+def benchmark_apply_patches():
+    """Time reverting long histories of large pages, comparing the current 
+    patch engine with the string concatenation one it replaced."""
+    rnd = random.Random(0)
+    print('{:>7} {:>9} {:>13} {:>13}'.format('lines', 'versions', 'concat (ms)', 'current (ms)'))
+    for n_lines, n_versions in ((1000, 200), (5000, 200), (5000, 1000), (20000, 500)):
+        lines = ['line {} {}\n'.format(i, 'x' * rnd.randrange(80)) for i in range(n_lines)]
+        md, patches = ''.join(lines), []
+        for v in range(n_versions):
+            for _ in range(rnd.randint(1, 5)):
+                lines[rnd.randrange(len(lines))] = 'edit {}\n'.format(v)
+            if rnd.random() < 0.3:
+                lines.insert(rnd.randrange(len(lines)), 'insert {}\n'.format(v))
+            new_md = ''.join(lines)
+            patches.append(unified_diff.make_patch(md, new_md))
+            md = new_md
+        patches.reverse()
+
+        def concat():
+            s = md
+            for patch in patches:
+                s = apply_patch_concat(s, patch, revert=True)
+            return s
+
+        def current():
+            return unified_diff.apply_patches(md, patches, revert=True)
+
+        assert concat() == current()
+        print('{:>7} {:>9} {:>13.1f} {:>13.1f}'.format(
+            n_lines, n_versions, min(timeit.repeat(concat, number=1, repeat=3)) * 1000,
+            min(timeit.repeat(current, number=1, repeat=3)) * 1000))
+
+
+@manager.option('-g', '--group', dest='group', required=True,
+                help='Group name (no whitespace) of the page')
+@manager.option('-p', '--page', dest='page_id', default=None,
+                help='Id of the page viewed, Home by default')
+@manager.option('-n', '--requests', dest='requests', type=int, default=200,
+                help='Number of views timed')
+def benchmark_page_views(group, page_id, requests):
+    """Time viewing a page as the admin, rendering it every time 
+    versus rendering its parts once, see `FRAGMENT_CACHE_BACKEND`."""
+    admin = WikiUser.objects(name=app.config['ADMIN_USERNAME']).first()
+    if page_id is None:
+        with switch_db(WikiPage, group) as _WikiPage:
+            page_id = str(_WikiPage.objects(title='Home').only('id').first().id)
+    url = '/{}/{}/page'.format(group, page_id)
+    fragments = main_views.wiki_fragments
+    login_manager.session_protection = None
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = str(admin.id)
+    print('{:>10} {:>12} {:>10}'.format('cache', 'requests/s', 'ms/view'))
+    try:
+        for name, cache in (('none', None), ('memory', MemoryFragmentCache(100))):
+            main_views.wiki_fragments = cache
+            assert client.get(url).status_code == 200
+            seconds = min(timeit.repeat(lambda: client.get(url), number=requests, repeat=3))
+            print('{:>10} {:>12.1f} {:>10.2f}'.format(
+                name, requests / seconds, seconds / requests * 1000))
+    finally:
+        main_views.wiki_fragments = fragments
+
+
+@manager.command
+def compression_report():
+    """Report the space taken by the markdown, html and history of the pages 
+    of each group, saved by compression so far, and which compressing the 
+    values stored as they are would save, see `COMPRESSION`."""
+    codec = app.config['COMPRESSION'] or 'zlib'
+    threshold = app.config['COMPRESSION_THRESHOLD']
+    print('{:<16} {:<28} {:>8} {:>10} {:>12} {:>12} {:>12}'.format(
+        'group', 'field', 'values', 'compressed', 'stored (KB)', 'saved (KB)', 'more (KB)'))
+    for group in active_groups():
+        for document, fields in ((WikiPage, ['md', 'html']), (WikiPageVersion, ['diff', 'keyframe'])):
+            with switch_db(document, group) as _document:
+                collection = _document._get_collection()
+                for field in fields:
+                    values = compressed = stored = saved = more = 0
+                    for doc in collection.find({field: {'$exists': True}}, {field: 1}):
+                        value = doc[field]
+                        values += 1
+                        if compression.is_compressed(value):
+                            compressed += 1
+                            stored += len(value)
+                            saved += len(compression.decompress(value)) - len(value)
+                        elif isinstance(value, str):
+                            data = value.encode('utf-8')
+                            stored += len(data)
+                            if len(data) >= threshold:
+                                more += max(0, len(data) - len(compression.compress(data, codec)))
+                    print('{:<16} {:<28} {:>8} {:>10} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+                        group, '{}.{}'.format(collection.name, field), values, compressed, 
+                        stored / 1024, saved / 1024, more / 1024))
+
+
+@manager.command
+def benchmark_compression():
+    """Time storing and reading back large markdown with each codec available, 
+    compared with plain strings, see `COMPRESSION`."""
+    rnd = random.Random(0)
+    field = WikiPage.md
+    codecs = [''] + [c for c in sorted(compression.subtypes) 
+                     if c != 'zstd' or compression.zstandard is not None]
+    print('{:>9} {:>6} {:>8} {:>11} {:>11}'.format('size (KB)', 'codec', 'ratio', 'write (ms)', 'read (ms)'))
+    threshold, codec = config.COMPRESSION_THRESHOLD, config.COMPRESSION
+    try:
+        config.COMPRESSION_THRESHOLD = 0
+        for n_rows in (50, 500, 5000):
+            # A pasted table and log, the kind of page compression is meant for
+            rows = ['| {} | {} | {:.3f} | {} |'.format(i, rnd.choice(['ok', 'failed', 'skipped']), 
+                                                       rnd.random() * 100, 'x' * rnd.randrange(40))
+                    for i in range(n_rows)]
+            logs = ['2017-06-{:02d} 12:{:02d}:{:02d} INFO worker {} done in {} ms'.format(
+                i % 30 + 1, i % 60, rnd.randrange(60), rnd.randrange(8), rnd.randrange(1000))
+                for i in range(n_rows)]
+            md = '| id | status | score | note |\n|---|---|---|---|\n' + '\n'.join(rows) + \
+                '\n\n```\n' + '\n'.join(logs) + '\n```\n'
+            size = len(md.encode('utf-8'))
+            for name in codecs:
+                config.COMPRESSION = name
+                stored = field.to_mongo(md)
+                assert field.to_python(stored) == md
+                stored_size = len(stored) if compression.is_compressed(stored) else size
+                write = min(timeit.repeat(lambda: field.to_mongo(md), number=10, repeat=3)) / 10
+                read = min(timeit.repeat(lambda: field.to_python(stored), number=10, repeat=3)) / 10
+                print('{:>9.1f} {:>6} {:>8.2f} {:>11.3f} {:>11.3f}'.format(
+                    size / 1024, name or 'none', size / stored_size, write * 1000, read * 1000))
+    finally:
+        config.COMPRESSION_THRESHOLD, config.COMPRESSION = threshold, codec
+
+
+@manager.command
+def rebuild_search_index():
+    """Build the BM25 search index of every group again, see `SEARCH_BACKEND`."""
+    if not isinstance(wiki_search, BM25Search):
+        print('SEARCH_BACKEND is not bm25, no index to build.')
+        return
+    for group in active_groups():
+        index = wiki_search.rebuild(group)
+        print('{}: {} pages, {} terms'.format(group, len(index.docs), len(index.postings)))
+
+
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='Return once no job is left to run')
+def run_jobs(once):
+    """Run the background jobs queued by the wiki, see `JOB_WORKERS`."""
+    wiki_jobs.run(forever=not once)
+
+
 if __name__ == '__main__':
     manager.run()